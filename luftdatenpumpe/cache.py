@@ -0,0 +1,172 @@
+# (c) 2026 Andreas Motl <andreas.motl@panodata.org>
+# License: GNU Affero General Public License, Version 3
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+import appdirs
+from dogpile.cache import register_backend
+from dogpile.cache.api import NO_VALUE, BytesBackend
+from dogpile.cache.backends.file import DBMBackend
+from dogpile.cache.backends.memory import MemoryBackend
+from dogpile.cache.backends.redis import RedisBackend
+
+from luftdatenpumpe import __appname__ as APP_NAME
+
+log = logging.getLogger(__name__)
+
+
+# Available cache backends for Nominatim and HTTP responses.
+CACHE_BACKENDS = ["redis", "sqlite", "dbm", "memory"]
+
+
+def cache_directory():
+    return appdirs.user_cache_dir(APP_NAME)
+
+
+class SQLiteBackend(BytesBackend):
+    """
+    A dogpile cache backend storing values in an SQLite database file.
+
+    Values are stored in a table clustered by key, and read through memory-mapped
+    I/O. When ``expiration_time`` is given, expired values are not returned, and
+    purged when opening the database.
+
+    Synopsis::
+
+        region = make_region().configure(
+            "luftdatenpumpe.sqlite",
+            arguments={"filename": "/path/to/cache.sqlite", "expiration_time": 3600},
+        )
+
+    """
+
+    mmap_size = 256 * 1024 * 1024
+
+    def __init__(self, arguments):
+        self.filename = arguments["filename"]
+        self.expiration_time = arguments.get("expiration_time")
+        self.lock = threading.RLock()
+        self._connection = None
+
+    @property
+    def connection(self):
+        with self.lock:
+            if self._connection is None:
+                log.info(f"Using cache database at {self.filename}")
+                directory = os.path.dirname(self.filename)
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+                self._connection = sqlite3.connect(self.filename, check_same_thread=False)
+                self._connection.execute("PRAGMA journal_mode=WAL")
+                self._connection.execute(f"PRAGMA mmap_size={self.mmap_size}")
+                self.ensure_schema()
+                self.purge()
+            return self._connection
+
+    def ensure_schema(self):
+        self._connection.execute("""
+            CREATE TABLE IF NOT EXISTS cache (
+                key TEXT PRIMARY KEY,
+                value BLOB,
+                expires REAL
+            ) WITHOUT ROWID
+            """)
+
+    def purge(self):
+        with self._connection:
+            self._connection.execute("DELETE FROM cache WHERE expires < ?", (time.time(),))
+
+    def get_serialized(self, key):
+        return self.get_serialized_multi([key])[0]
+
+    def get_serialized_multi(self, keys):
+        keys = list(keys)
+        placeholders = ", ".join("?" * len(keys))
+        with self.lock:
+            cursor = self.connection.execute(
+                f"SELECT key, value FROM cache WHERE key IN ({placeholders}) AND (expires IS NULL OR expires >= ?)",
+                keys + [time.time()],
+            )
+            values = dict(cursor.fetchall())
+        return [values.get(key, NO_VALUE) for key in keys]
+
+    def set_serialized(self, key, value):
+        self.set_serialized_multi({key: value})
+
+    def set_serialized_multi(self, mapping):
+        expires = None
+        if self.expiration_time:
+            expires = time.time() + self.expiration_time
+        records = [(key, value, expires) for key, value in mapping.items()]
+        with self.lock, self.connection:
+            self.connection.executemany("REPLACE INTO cache (key, value, expires) VALUES (?, ?, ?)", records)
+
+    def delete(self, key):
+        self.delete_multi([key])
+
+    def delete_multi(self, keys):
+        with self.lock, self.connection:
+            self.connection.executemany("DELETE FROM cache WHERE key=?", [(key,) for key in keys])
+
+
+register_backend("luftdatenpumpe.sqlite", "luftdatenpumpe.cache", "SQLiteBackend")
+
+
+def dogpile_backend(backend, name, expiration_time=None):
+    """
+    Return the dogpile backend name and its arguments for the given cache backend.
+    """
+    if backend == "redis":
+        return "dogpile.cache.redis", {}
+    elif backend == "sqlite":
+        filename = os.path.join(cache_directory(), f"{name}.sqlite")
+        return "luftdatenpumpe.sqlite", {"filename": filename, "expiration_time": expiration_time}
+    elif backend == "dbm":
+        os.makedirs(cache_directory(), exist_ok=True)
+        return "dogpile.cache.dbm", {"filename": os.path.join(cache_directory(), f"{name}.dbm")}
+    elif backend == "memory":
+        return "dogpile.cache.memory", {}
+    raise ValueError(f'Unknown cache backend "{backend}", use one of {CACHE_BACKENDS}')
+
+
+def cached_keys(region, prefix):
+    """
+    Return all keys of the given cache region starting with the given prefix.
+    """
+    backend = region.backend
+    if isinstance(backend, SQLiteBackend):
+        with backend.lock:
+            sql = "SELECT key FROM cache WHERE substr(key, 1, ?) = ?"
+            cursor = backend.connection.execute(sql, (len(prefix), prefix))
+            return [key for (key,) in cursor]
+    elif isinstance(backend, RedisBackend):
+        pattern = prefix.replace("[", "\\[").replace("*", "\\*").replace("?", "\\?") + "*"
+        return [key.decode() for key in backend.reader_client.scan_iter(match=pattern, count=1000)]
+    elif isinstance(backend, DBMBackend):
+        with backend._dbm_file(False) as dbm:
+            # Not all dbm implementations support iteration.
+            return [key.decode() for key in dbm.keys() if key.decode().startswith(prefix)]  # noqa:SIM118
+    elif isinstance(backend, MemoryBackend):
+        return [key for key in list(backend._cache) if key.startswith(prefix)]
+    raise NotImplementedError(f"Unable to enumerate keys of cache backend {backend}")
+
+
+def requests_cache_backend(backend, name):
+    """
+    Return keyword arguments for ``CachedSession`` for the given cache backend.
+
+    requests-cache does not provide a dbm backend, so responses are
+    stored within a directory on the filesystem instead.
+    """
+    if backend == "redis":
+        return {"cache_name": name, "backend": "redis"}
+    elif backend == "sqlite":
+        return {"cache_name": os.path.join(cache_directory(), "http", f"{name}.sqlite"), "backend": "sqlite"}
+    elif backend == "dbm":
+        return {"cache_name": os.path.join(cache_directory(), "http", name), "backend": "filesystem"}
+    elif backend == "memory":
+        return {"cache_name": name, "backend": "memory"}
+    raise ValueError(f'Unknown cache backend "{backend}", use one of {CACHE_BACKENDS}')
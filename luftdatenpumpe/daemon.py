@@ -0,0 +1,93 @@
+# (c) 2026 Andreas Motl <andreas.motl@panodata.org>
+# License: GNU Affero General Public License, Version 3
+import logging
+import random
+import signal
+import time
+from threading import Event, Thread
+
+log = logging.getLogger(__name__)
+
+
+class Job:
+    """
+    Invoke a function periodically, optionally delayed by a random jitter.
+
+    When an invocation overruns its interval, the ticks missed in the meanwhile
+    are skipped, so invocations of the same job will never overlap.
+    """
+
+    def __init__(self, name, function, interval, jitter=0):
+        self.name = name
+        self.function = function
+        self.interval = interval
+        self.jitter = jitter
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} {self.name} interval={self.interval}s jitter={self.jitter}s>"
+
+    def run_forever(self, stopped):
+        next_run = time.monotonic()
+        while not stopped.is_set():
+
+            # Wait for the next tick, plus jitter.
+            delay = next_run + random.uniform(0, self.jitter) - time.monotonic()
+            if stopped.wait(max(delay, 0)):
+                break
+
+            started = time.monotonic()
+            self.run_once()
+            duration = time.monotonic() - started
+
+            # Advance to the next tick, skipping those missed while the job was running.
+            next_run += self.interval
+            skipped = 0
+            while next_run <= time.monotonic():
+                next_run += self.interval
+                skipped += 1
+            if skipped:
+                log.warning(f'Job "{self.name}" took {duration:.1f}s, skipping {skipped} tick(s)')
+
+    def run_once(self):
+        log.info(f'Running job "{self.name}"')
+        try:
+            self.function()
+        except (Exception, SystemExit):
+            log.exception(f'Job "{self.name}" failed')
+
+
+class Scheduler:
+    """
+    Run a number of periodic jobs, each on its own thread,
+    until receiving SIGINT or SIGTERM.
+    """
+
+    def __init__(self):
+        self.jobs = []
+        self.stopped = Event()
+
+    def add_job(self, job):
+        self.jobs.append(job)
+
+    def stop(self, *args):
+        log.info("Shutting down scheduler")
+        self.stopped.set()
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+
+        threads = []
+        for job in self.jobs:
+            log.info(f"Scheduling {job}")
+            thread = Thread(target=job.run_forever, args=(self.stopped,), name=f"job-{job.name}", daemon=True)
+            thread.start()
+            threads.append(thread)
+
+        try:
+            while not self.stopped.wait(1):
+                pass
+        except KeyboardInterrupt:
+            self.stop()
+
+        for thread in threads:
+            thread.join()
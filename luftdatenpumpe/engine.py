@@ -3,7 +3,8 @@
 # License: GNU Affero General Public License, Version 3
 import json
 import logging
-from urllib.parse import urlparse
+import time
+from urllib.parse import parse_qsl, urlencode, urlparse, urlunparse
 
 from munch import Munch
 from tqdm import tqdm
@@ -18,12 +19,109 @@ from luftdatenpumpe.target.json import (
 from luftdatenpumpe.target.mqtt import MQTTAdapter
 from luftdatenpumpe.target.rdbms import RDBMSStorage
 from luftdatenpumpe.target.stream import StreamTarget
+from luftdatenpumpe.target.threaded import ThreadedTarget
 
 log = logging.getLogger(__name__)
 
 
+class FlushPolicy:
+    """
+    Decide when to flush a data sink preliminary.
+
+    A flush is triggered when any of the configured thresholds is exceeded.
+
+    - ``items``: Number of buffered items, i.e. readings or stations.
+    - ``points``: Number of buffered data points, i.e. observations.
+      A single IRCELINE reading can carry 12 hours worth of observations.
+    - ``bytes``: Size of buffered items, serialized to JSON.
+    - ``latency``: Seconds elapsed since the first item has been buffered.
+      This is checked whenever an item arrives.
+
+    The thresholds can be configured per data sink by using query parameters
+    on the target expression, e.g.::
+
+        influxdb://localhost/luftdaten_info?batch-points=5000&batch-latency=10
+
+    """
+
+    parameters = ("items", "points", "bytes", "latency")
+    prefix = "batch-"
+
+    def __init__(self, items=None, points=None, bytes=None, latency=None):
+        self.items = items
+        self.points = points
+        self.bytes = bytes
+        self.latency = latency
+        self.reset()
+
+    def __repr__(self):
+        settings = ", ".join(f"{name}={getattr(self, name)}" for name in self.parameters if getattr(self, name))
+        return f"<{self.__class__.__name__} {settings}>"
+
+    @property
+    def configured(self):
+        return any(getattr(self, name) for name in self.parameters)
+
+    def reset(self):
+        self.item_count = 0
+        self.point_count = 0
+        self.byte_count = 0
+        self.started = None
+
+    def account(self, points=1, size=0):
+        if self.started is None:
+            self.started = time.monotonic()
+        self.item_count += 1
+        self.point_count += points
+        self.byte_count += size
+
+    def due(self):
+        if self.items and self.item_count >= self.items:
+            return True
+        if self.points and self.point_count >= self.points:
+            return True
+        if self.bytes and self.byte_count >= self.bytes:
+            return True
+        return bool(self.latency and self.started is not None and time.monotonic() - self.started >= self.latency)
+
+    def derive(self, expression):
+        """
+        Derive flush policy for a specific data sink from query parameters
+        of its target expression. Returns the policy and the target expression
+        with those query parameters removed.
+        """
+        settings = {name: getattr(self, name) for name in self.parameters}
+
+        url = urlparse(expression)
+        query = parse_qsl(url.query, keep_blank_values=True)
+        remaining = []
+        for key, value in query:
+            name = key.replace(self.prefix, "", 1)
+            if key.startswith(self.prefix) and name in self.parameters:
+                settings[name] = float(value) if name == "latency" else int(value)
+            else:
+                remaining.append((key, value))
+
+        if len(remaining) != len(query):
+            expression = urlunparse(url._replace(query=urlencode(remaining)))
+
+        return FlushPolicy(**settings), expression
+
+
 class LuftdatenEngine:
-    def __init__(self, network, domain, targets, fieldmap=None, batch_size=None, progressbar=False, dry_run=False):
+    def __init__(
+        self,
+        network,
+        domain,
+        targets,
+        fieldmap=None,
+        batch_size=None,
+        progressbar=False,
+        dry_run=False,
+        concurrent_targets=False,
+        queue_size=None,
+        flush_policy=None,
+    ):
         self.network = network
         self.domain = domain
         self.targets = targets
@@ -31,14 +129,34 @@ class LuftdatenEngine:
         self.batch_size = batch_size or 1
         self.progressbar = progressbar
         self.dry_run = dry_run
+        self.concurrent_targets = concurrent_targets
+        self.queue_size = queue_size or 1000
+        self.flush_policy = flush_policy or FlushPolicy()
 
-    def process(self, data):
+        # Data sinks and their flush policies, configured on first use.
+        self.sinks = None
+
+    def configure_targets(self):
+        """
+        Resolve all target expressions to data sinks, once.
+        Subsequent invocations of ``process`` will reuse them.
+        """
+
+        if self.sinks is not None:
+            return self.sinks
 
         # Configure target subsystems.
         targets = []
+        policies = []
         for target_expression in self.targets:
             log.info(f'Configuring data sink "{target_expression}" with domain "{self.domain}"')
 
+            # Derive flush policy from target expression.
+            # When no thresholds are configured, flush each $batch_size items.
+            policy, target_expression = self.flush_policy.derive(target_expression)
+            if not policy.configured:
+                policy.items = self.batch_size
+
             try:
                 target = self.resolve_target_handler(target_expression, dry_run=self.dry_run)
 
@@ -54,39 +172,94 @@ class LuftdatenEngine:
                 log.warning(f'Data sink {target_expression} does not handle domain "{self.domain}"')
                 continue
 
+            # Optionally, run each data sink on its own worker thread.
+            if self.concurrent_targets:
+                target = ThreadedTarget(target, queue_size=self.queue_size)
+
+            log.debug(f"Using {policy} for data sink {target}")
             targets.append(target)
+            policies.append(policy)
 
         # Sanity checks.
         if not targets:
             raise ValueError("No data sinks enabled, please check the log file for errors")
 
+        self.sinks = list(zip(targets, policies))
+        return self.sinks
+
+    def process(self, data):
+
+        # Configure target subsystems.
+        sinks = self.configure_targets()
+        targets = [target for target, policy in sinks]
+        policies = [policy for target, policy in sinks]
+        for policy in policies:
+            policy.reset()
+
         # Emit to active target subsystems.
         log.info("Emitting to target data sinks, this might take some time")
 
         if self.progressbar:
             data = tqdm(data)
 
-        item_count = 0
-        for item in data:
+        # Only serialize items when needed.
+        measure_size = any(policy.bytes for policy in policies)
 
-            for target in targets:
-                target.emit(item)
-            item_count += 1
+        item_count = 0
+        try:
+            for item in data:
 
-            # Preliminary flush each $batch_size items.
-            if item_count % self.batch_size == 0:
                 for target in targets:
+                    target.emit(item)
+                item_count += 1
+
+                # Readings carry multiple observations, stations count as a single data point.
+                points = len(item.get("observations", [None]))
+                size = measure_size and len(json.dumps(item, default=str)) or 0
+
+                # Preliminary flush according to flush policy.
+                for target, policy in zip(targets, policies):
                     # Don't flush STDOUT targets preliminary, otherwise JSON output breaks.
-                    if isinstance(target, StreamTarget):
+                    if isinstance(getattr(target, "target", target), StreamTarget):
                         continue
-                    target.flush()
+                    policy.account(points=points, size=size)
+                    if policy.due():
+                        target.flush()
+                        policy.reset()
 
-        # Signal final readiness to each target subsystem.
-        for target in targets:
-            target.flush(final=True)
+        # Signal final readiness to each target subsystem, also when processing fails.
+        finally:
+            self.finalize(targets)
 
         log.info("Processed {} records".format(item_count))
 
+    def finalize(self, targets):
+        """
+        Signal final readiness to all data sinks. On concurrent targets, this will
+        also wait for their queues to drain, and shut down their worker threads.
+
+        Errors are collected, so a failing data sink will not prevent finalizing the
+        others, and re-raised after all of them have been processed.
+        """
+        errors = []
+        for target in targets:
+            try:
+                target.flush(final=True)
+            except Exception as ex:
+                log.exception(f"Flushing data sink {target} failed")
+                errors.append(ex)
+
+        for target in targets:
+            if isinstance(target, ThreadedTarget):
+                try:
+                    target.close()
+                except Exception as ex:
+                    log.exception(f"Closing data sink {target} failed")
+                    errors.append(ex)
+
+        if errors:
+            raise errors[0]
+
     def resolve_target_handler(self, target, dry_run=False):
         handler = None
 
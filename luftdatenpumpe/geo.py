@@ -2,17 +2,26 @@
 # (c) 2017,2018 Andreas Motl <andreas@hiveeyes.org>
 # (c) 2017,2018 Richard Pobering <richard@hiveeyes.org>
 # License: GNU Affero General Public License, Version 3
+import functools
+import gzip
+import json
 import logging
+import math
 import re
+import threading
 import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
 
 import geohash2
 from dogpile.cache import make_region
+from dogpile.cache.api import NO_VALUE
 from dogpile.cache.util import kwarg_function_key_generator, to_list
 from geopy.geocoders import Nominatim
 from munch import Munch
 
+from luftdatenpumpe.cache import cached_keys, dogpile_backend
 from luftdatenpumpe.util import invalidate_dogpile_cache
 
 from . import __appname__ as APP_NAME
@@ -21,13 +30,133 @@ from . import __version__ as APP_VERSION
 log = logging.getLogger(__name__)
 
 
-# Configure cache for responses from Nominatim
+class LRUCache:
+    """
+    Bounded in-memory cache, evicting the least recently used entries, and counting hits and misses.
+    """
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __repr__(self):
+        return (
+            f"<{self.__class__.__name__} size={len(self.entries)} maxsize={self.maxsize} "
+            f"hits={self.hits} misses={self.misses}>"
+        )
+
+    def get(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            self.misses += 1
+            return NO_VALUE
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def cache_on_arguments(self):
+        """
+        Decorate a function to cache its results, keyed like ``kwarg_function_key_generator``.
+        Exceptions raised by the function are not cached.
+        """
+
+        def decorator(fn):
+            key_generator = kwarg_function_key_generator(None, fn)
+
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                key = key_generator(*args, **kwargs)
+                value = self.get(key)
+                if value is NO_VALUE:
+                    value = fn(*args, **kwargs)
+                    self.set(key, value)
+                return value
+
+            return wrapper
+
+        return decorator
+
+
+# Configure cache for responses from Nominatim, see also ``configure_nominatim_cache``.
 nominatim_cache = make_region(function_key_generator=kwarg_function_key_generator).configure("dogpile.cache.redis")
 
+# Cache responses from Nominatim for 3 months.
+nominatim_cache_ttl = 60 * 60 * 24 * 30 * 3
+
+# Keep recently used responses from Nominatim in memory, in front of the Redis cache,
+# in order to save round-trips and unpickling when processing the same stations repeatedly.
+nominatim_memory_cache = LRUCache(maxsize=20000)
+
 # Configure Nominatim client
 nominatim_user_agent = APP_NAME + "/" + APP_VERSION
 
 
+# Maximum request rates per Nominatim endpoint, in requests per second.
+# The public instance has a fair use policy of an absolute maximum of 1 request per second.
+# https://operations.osmfoundation.org/policies/nominatim/
+nominatim_rate_limits = {
+    "nominatim.hiveeyes.org": 50.0,
+    "nominatim.openstreetmap.org": 1.0,
+}
+
+
+class TokenBucket:
+    """
+    Limit the rate of operations across all threads, permitting bursts of up to ``capacity`` operations.
+    """
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Block until a token is available, and consume it.
+        """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+
+
+rate_limiters = {}
+rate_limiters_lock = threading.Lock()
+
+
+def rate_limit(domain):
+    """
+    Wait until the rate limit of the given Nominatim endpoint permits another request.
+    """
+    with rate_limiters_lock:
+        if domain not in rate_limiters:
+            rate = nominatim_rate_limits.get(domain, 1.0)
+            rate_limiters[domain] = TokenBucket(rate, capacity=max(int(rate), 1))
+    rate_limiters[domain].acquire()
+
+
 # Maybe also add building, public_building
 osm_address_fields = [
     "continent",
@@ -66,6 +195,12 @@ def resolve_location(latitude=None, longitude=None, geohash=None, country_code=N
     if latitude is None and longitude is None and geohash is not None:
         latitude, longitude = geohash_decode(geohash)
 
+    # Reuse the nearest location already known, if close enough.
+    if nearby_index is not None:
+        location = nearby_index.nearest(latitude, longitude)
+        if location is not None:
+            return rebundle_location(location)
+
     # Run reverse geocoder.
     location = reverse_geocode(latitude, longitude, country_code)
 
@@ -76,26 +211,51 @@ def resolve_location(latitude=None, longitude=None, geohash=None, country_code=N
     if location is None or "error" in location:
         raise ValueError("Reverse geocoding failed for lat={}, lon={}".format(latitude, longitude))
 
+    if nearby_index is not None:
+        nearby_index.add(latitude, longitude, location)
+
     location = rebundle_location(location)
 
     return location
 
 
+def resolve_locations(positions, workers=1):
+    """
+    Reverse-geocode a number of positions, each a tuple of ``(latitude, longitude, country_code)``.
+
+    Returns a mapping of positions to locations. Positions which failed to resolve are mapped
+    to the corresponding exception. Each distinct position is resolved only once, concurrently
+    using a pool of worker threads, while requests are throttled per Nominatim endpoint.
+    """
+
+    def resolve(position):
+        latitude, longitude, country_code = position
+        try:
+            return resolve_location(latitude=latitude, longitude=longitude, country_code=country_code)
+        except Exception as ex:  # noqa:BLE001
+            return ex
+
+    positions = list(dict.fromkeys(positions))
+    log.info(f"Reverse geocoding {len(positions)} positions using {workers} workers")
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="geocode") as executor:
+        return dict(zip(positions, executor.map(resolve, positions)))
+
+
 def rebundle_location(location):
 
+    # Leave the original location untouched, as it might be shared by the in-memory cache.
     address = Munch()
     for field in osm_address_fields:
         if field in location["address"]:
             address[field] = location["address"][field]
-            del location["address"][field]
 
     address_more = Munch()
     for key, value in location["address"].items():
-        address_more[key] = value
-
-    del location["address"]
+        if key not in address:
+            address_more[key] = value
 
     result = Munch(location)
+    del result["address"]
     result.address = address
 
     if address_more:
@@ -104,8 +264,8 @@ def rebundle_location(location):
     return result
 
 
-# Cache responses from Nominatim for 3 months
-@nominatim_cache.cache_on_arguments(expiration_time=60 * 60 * 24 * 30 * 3)
+@nominatim_memory_cache.cache_on_arguments()
+@nominatim_cache.cache_on_arguments(expiration_time=nominatim_cache_ttl)
 def reverse_geocode(latitude, longitude, country_code):
     """
     Cache responses of the Nominatim reverse geocoding service.
@@ -144,6 +304,7 @@ def reverse_geocode_main(latitude, longitude):
     try:
         geolocator = Nominatim(domain="nominatim.hiveeyes.org", user_agent=nominatim_user_agent, timeout=1.25)
         position = (latitude, longitude)
+        rate_limit(geolocator.domain)
         location = geolocator.reverse(position).raw
 
         # Sanity checks
@@ -176,17 +337,16 @@ def reverse_geocode_fallback(latitude, longitude):
         # geolocator = Nominatim(user_agent=nominatim_user_agent, scheme='http')
 
         position = (latitude, longitude)
+
+        # Obey to fair use policy (an absolute maximum of 1 request per second).
+        # https://operations.osmfoundation.org/policies/nominatim/
+        rate_limit(geolocator.domain)
         location = geolocator.reverse(position).raw
 
     except Exception as ex:
         name = ex.__class__.__name__
         log.error("Reverse geocoding II failed: {}: {}. lat={}, lon={}".format(name, ex, latitude, longitude))
 
-    finally:
-        # Obey to fair use policy (an absolute maximum of 1 request per second).
-        # https://operations.osmfoundation.org/policies/nominatim/
-        time.sleep(1)
-
     return location
 
 
@@ -393,10 +553,210 @@ def geohash_decode(geohash):
     return geohash2.decode(geohash)
 
 
+class LocationIndex:
+    """
+    Spatial index of resolved locations, for looking up the nearest known location
+    within a given distance in metres, without querying Nominatim.
+
+    Positions are bucketed by geohash prefix. Lookups inspect all buckets
+    intersecting the bounding box of the search radius. Use ``precision_for``
+    to choose buckets matching the distance, so only a few of them are inspected.
+    """
+
+    # Circumference of the earth per degree of latitude, in metres.
+    metres_per_degree = 111320
+
+    def __init__(self, distance, precision=7):
+        self.distance = distance
+        self.precision = precision
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+        # Compute the size of the buckets, in degrees.
+        latitude_bits = 5 * precision // 2
+        longitude_bits = 5 * precision - latitude_bits
+        self.cell_height = 180 / 2**latitude_bits
+        self.cell_width = 360 / 2**longitude_bits
+
+    def __len__(self):
+        return sum(map(len, self.buckets.values()))
+
+    @classmethod
+    def precision_for(cls, distance):
+        """
+        Return the finest geohash precision where buckets are not smaller than the given distance in metres.
+        """
+        for precision in range(12, 1, -1):
+            latitude_bits = 5 * precision // 2
+            longitude_bits = 5 * precision - latitude_bits
+            size = min(180 / 2**latitude_bits, 360 / 2**longitude_bits) * cls.metres_per_degree
+            if size >= distance:
+                return precision
+        return 1
+
+    def add(self, latitude, longitude, location):
+        latitude, longitude = float(latitude), float(longitude)
+        key = geohash2.encode(latitude, longitude, precision=self.precision)
+        with self.lock:
+            self.buckets.setdefault(key, []).append((latitude, longitude, location))
+
+    def nearest(self, latitude, longitude):
+        """
+        Return the location nearest to the given position within the configured distance, or ``None``.
+        """
+        latitude, longitude = float(latitude), float(longitude)
+        nearest = None
+        nearest_distance = self.distance
+        for key in self.cells(latitude, longitude):
+            for candidate_latitude, candidate_longitude, location in self.buckets.get(key, []):
+                distance = haversine_distance(latitude, longitude, candidate_latitude, candidate_longitude)
+                if distance <= nearest_distance:
+                    nearest, nearest_distance = location, distance
+        return nearest
+
+    def cells(self, latitude, longitude):
+        """
+        Compute geohash prefixes of all buckets intersecting the bounding box of the search radius.
+        """
+        delta_latitude = self.distance / self.metres_per_degree
+        delta_longitude = delta_latitude / max(math.cos(math.radians(latitude)), 0.01)
+        cells = set()
+        cell_latitude = max(latitude - delta_latitude, -90)
+        while True:
+            cell_longitude = longitude - delta_longitude
+            while True:
+                wrapped_longitude = (cell_longitude + 180) % 360 - 180
+                cells.add(geohash2.encode(cell_latitude, wrapped_longitude, precision=self.precision))
+                if cell_longitude >= longitude + delta_longitude:
+                    break
+                cell_longitude = min(cell_longitude + self.cell_width, longitude + delta_longitude)
+            if cell_latitude >= min(latitude + delta_latitude, 90):
+                break
+            cell_latitude = min(cell_latitude + self.cell_height, latitude + delta_latitude, 90)
+        return cells
+
+
+def haversine_distance(latitude1, longitude1, latitude2, longitude2):
+    """
+    Compute the great-circle distance between two positions, in metres.
+    """
+    latitude1, longitude1, latitude2, longitude2 = map(math.radians, (latitude1, longitude1, latitude2, longitude2))
+    a = (
+        math.sin((latitude2 - latitude1) / 2) ** 2
+        + math.cos(latitude1) * math.cos(latitude2) * math.sin((longitude2 - longitude1) / 2) ** 2
+    )
+    return 2 * 6371008.8 * math.asin(math.sqrt(a))
+
+
+# Spatial index of known locations, see ``configure_nearby_index``.
+nearby_index = None
+
+
+def configure_nearby_index(distance, locations=None):
+    """
+    Reuse known locations for positions within the given distance in metres.
+
+    The index is built from all responses within the Nominatim cache, and
+    from the given additional locations, as triples of ``(latitude, longitude, location)``.
+    """
+    global nearby_index
+    index = LocationIndex(distance, precision=LocationIndex.precision_for(distance))
+
+    # Add responses from the Nominatim cache.
+    for key, location in cached_locations():
+        latitude, longitude = key.split(" ")[-2:]
+        index.add(latitude, longitude, location)
+
+    # Add further locations, e.g. from a database.
+    for latitude, longitude, location in locations or []:
+        index.add(latitude, longitude, location)
+
+    log.info(f"Indexed {len(index)} known locations for reuse within {distance} metres")
+    nearby_index = index
+
+
+def cached_locations(chunksize=1000):
+    """
+    Iterate all unexpired responses within the Nominatim cache, as pairs of cache key and location.
+    """
+    keys = cached_keys(nominatim_cache, nominatim_cache_prefix())
+    for offset in range(0, len(keys), chunksize):
+        chunk = keys[offset : offset + chunksize]
+        for key, location in zip(chunk, nominatim_cache.get_multi(chunk, expiration_time=nominatim_cache_ttl)):
+            if location is NO_VALUE:
+                continue
+            if hasattr(location, "raw"):
+                location = location.raw
+            yield key, location
+
+
+def nominatim_cache_prefix():
+    return kwarg_function_key_generator(None, reverse_geocode)()
+
+
+def export_nominatim_cache(path):
+    """
+    Write all responses within the Nominatim cache to the given file, in JSON Lines format,
+    one object of ``key`` and ``location`` per line. Files ending with ``.gz`` are compressed.
+    """
+    count = 0
+    with open_text_file(path, "w") as stream:
+        for key, location in cached_locations():
+            stream.write(json.dumps({"key": key, "location": location}, ensure_ascii=False, separators=(",", ":")))
+            stream.write("\n")
+            count += 1
+    return count
+
+
+def import_nominatim_cache(path, chunksize=1000):
+    """
+    Load responses into the Nominatim cache from a file written by ``export_nominatim_cache``.
+    Imported responses expire as if they had been requested at the time of import.
+    """
+    prefix = nominatim_cache_prefix()
+    count = 0
+    mapping = {}
+    with open_text_file(path, "r") as stream:
+        for line in stream:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            if not entry["key"].startswith(prefix):
+                log.warning(f"Skipping unknown cache key {entry['key']}")
+                continue
+            mapping[entry["key"]] = entry["location"]
+            if len(mapping) >= chunksize:
+                nominatim_cache.set_multi(mapping)
+                count += len(mapping)
+                mapping = {}
+    if mapping:
+        nominatim_cache.set_multi(mapping)
+        count += len(mapping)
+    nominatim_memory_cache.clear()
+    return count
+
+
+def open_text_file(path, mode):
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t", encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+
+def configure_nominatim_cache(backend):
+    """
+    Select the cache backend for responses from Nominatim, see ``luftdatenpumpe.cache``.
+    """
+    log.info(f'Using Nominatim cache backend "{backend}"')
+    name, arguments = dogpile_backend(backend, "nominatim", expiration_time=nominatim_cache_ttl)
+    nominatim_cache.configure(name, arguments=arguments, replace_existing_backend=True)
+    nominatim_memory_cache.clear()
+
+
 def disable_nominatim_cache():
     log.info("Disabling Nominatim cache")
     # Invalidate the Nominatim cache; this applies only for this session, it will _not_ _purge_ all data at once.
     invalidate_dogpile_cache(nominatim_cache)
+    nominatim_memory_cache.clear()
 
 
 if __name__ == "__main__":
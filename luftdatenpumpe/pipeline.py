@@ -0,0 +1,126 @@
+# (c) 2026 Andreas Motl <andreas.motl@panodata.org>
+# License: GNU Affero General Public License, Version 3
+import logging
+from queue import Empty, Full, Queue
+from threading import Event, Thread
+
+log = logging.getLogger(__name__)
+
+
+class StageError:
+    """
+    Carry an exception raised within a pipeline stage down to the consumer.
+    """
+
+    def __init__(self, exception):
+        self.exception = exception
+
+
+class Pipeline:
+    """
+    Run the processing stages of a data source on individual threads,
+    connected by bounded queues.
+
+    The first stage consumes the source iterable, i.e. it acquires and
+    decodes data. Each subsequent stage applies its function to all items,
+    dropping those where the function returns ``None``. The consumer, i.e.
+    ``LuftdatenEngine.process``, iterates the pipeline and emits to the
+    data sinks on the main thread.
+
+    When a data sink stalls, the queues will fill up and block the upstream
+    stages, so memory consumption stays bounded by the queue depth.
+
+    Exceptions raised within a stage are re-raised on the consumer side.
+
+    Synopsis::
+
+        pipeline = Pipeline(pump.get_readings(), depth=250)
+        pipeline.add_stage("enrich", pump.enrich_item)
+        for reading in pipeline:
+            print(reading)
+
+    """
+
+    END = object()
+    TIMEOUT = 0.25
+
+    def __init__(self, source, depth=100):
+        self.source = source
+        self.depth = depth
+        self.stages = []
+        self.stopped = Event()
+
+    def add_stage(self, name, function):
+        self.stages.append((name, function))
+        return self
+
+    def __iter__(self):
+
+        # Connect all stages by bounded queues.
+        outbox = Queue(maxsize=self.depth)
+        threads = [Thread(target=self.feed, args=(self.source, outbox), name="pipeline-source", daemon=True)]
+        for name, function in self.stages:
+            inbox, outbox = outbox, Queue(maxsize=self.depth)
+            threads.append(
+                Thread(target=self.transform, args=(function, inbox, outbox), name=f"pipeline-{name}", daemon=True)
+            )
+
+        for thread in threads:
+            thread.start()
+
+        # Consume items from the last stage.
+        try:
+            while True:
+                item = outbox.get()
+                if item is self.END:
+                    break
+                if isinstance(item, StageError):
+                    raise item.exception
+                yield item
+
+        # Signal all stages to shut down, also when the consumer bails out.
+        finally:
+            self.stopped.set()
+
+    def put(self, queue, item):
+        while not self.stopped.is_set():
+            try:
+                queue.put(item, timeout=self.TIMEOUT)
+                return True
+            except Full:
+                continue
+        return False
+
+    def get(self, queue):
+        while not self.stopped.is_set():
+            try:
+                return queue.get(timeout=self.TIMEOUT)
+            except Empty:
+                continue
+        return self.END
+
+    def feed(self, source, outbox):
+        try:
+            for item in source:
+                if not self.put(outbox, item):
+                    return
+        except Exception as ex:  # noqa:BLE001
+            self.put(outbox, StageError(ex))
+            return
+        self.put(outbox, self.END)
+
+    def transform(self, function, inbox, outbox):
+        while True:
+            item = self.get(inbox)
+            if item is self.END or isinstance(item, StageError):
+                self.put(outbox, item)
+                return
+            try:
+                item = function(item)
+            except Exception as ex:  # noqa:BLE001
+                self.put(outbox, StageError(ex))
+                return
+            if item is None:
+                continue
+            if not self.put(outbox, item):
+                return
@@ -5,11 +5,13 @@ import logging
 
 from munch import Munch
 
-from luftdatenpumpe.geo import disable_nominatim_cache
+from luftdatenpumpe.geo import configure_nearby_index, configure_nominatim_cache, disable_nominatim_cache
 from luftdatenpumpe.source.eea import EEAAirQualityPumpe
 from luftdatenpumpe.source.irceline import IrcelinePumpe
 from luftdatenpumpe.source.luftdaten_info import LuftdatenPumpe
 from luftdatenpumpe.source.openaq import OpenAQPumpe
+from luftdatenpumpe.source.rdbms import locations_from_rdbms
+from luftdatenpumpe.state import StateStore
 from luftdatenpumpe.util import read_list
 
 log = logging.getLogger(__name__)
@@ -65,11 +67,22 @@ def resolve_source_handler(options, dry_run=False):
     if not options["target"]:
         options["target"] = ["json+stream://sys.stdout"]
 
+    # Select cache backend for Nominatim responses.
+    configure_nominatim_cache(options["cache-backend"])
+
     # Optionally disable Nominatim cache.
     if options["disable-nominatim-cache"]:
         # Invalidate the Nominatim cache; this applies only for this session, it will _not_ _purge_ all data at once.
         disable_nominatim_cache()
 
+    # Optionally reuse locations of nearby positions already known from the Nominatim cache and the database.
+    if options["reverse-geocode"] and options["geocode-nearby"]:
+        locations = []
+        for target in options["target"]:
+            if target.startswith("postgresql://"):
+                locations += locations_from_rdbms(target, options.network)
+        configure_nearby_index(options["geocode-nearby"], locations=locations)
+
     # The main workhorse.
     pump = datapump_class(
         source=options["source"],
@@ -77,6 +90,16 @@ def resolve_source_handler(options, dry_run=False):
         reverse_geocode=options["reverse-geocode"],
         progressbar=options["progress"],
         dry_run=options["dry-run"],
+        state=StateStore.from_directory(options["state-dir"]),
+        incremental=options["incremental"],
+        conditional_requests=options["conditional-requests"],
+        domain=options.domain,
+        workers=options["workers"],
+        unordered=options["unordered"],
+        concurrency=options["concurrency"],
+        bulk=options["bulk"],
+        metadata_ttl=options["metadata-ttl"],
+        cache_backend=options["cache-backend"],
     )
 
     return pump
@@ -4,20 +4,32 @@
 # License: GNU Affero General Public License, Version 3
 import logging
 import sys
+from copy import deepcopy
+from itertools import islice
 from urllib.parse import urlparse
 
 import redis
 import requests
+from munch import Munch
+from requests.adapters import HTTPAdapter
 from requests_cache import CachedSession
 from tqdm import tqdm
+from urllib3.util.retry import Retry
 
 from luftdatenpumpe import __appname__ as APP_NAME
 from luftdatenpumpe import __version__ as APP_VERSION
-from luftdatenpumpe.geo import format_address, geohash_encode, improve_location, resolve_location
+from luftdatenpumpe.cache import requests_cache_backend
+from luftdatenpumpe.geo import format_address, geohash_encode, improve_location, resolve_location, resolve_locations
 
 log = logging.getLogger(__name__)
 
 
+class NotModified(Exception):
+    """
+    Signal that upstream data has not been modified since the previous invocation.
+    """
+
+
 class AbstractLuftdatenPumpe:
 
     network = None
@@ -26,8 +38,31 @@ class AbstractLuftdatenPumpe:
     cache_enabled = False
     cache_ttl = 300
 
+    # Retry failed HTTP requests, with exponential backoff.
+    http_retries = 3
+    http_backoff_factor = 0.5
+
+    # Number of items to reverse-geocode at once, when enriching in batches.
+    geocoding_batch_size = 1000
+
     def __init__(
-        self, source=None, filter=None, reverse_geocode=False, progressbar=False, quick_mode=False, dry_run=False
+        self,
+        source=None,
+        filter=None,
+        reverse_geocode=False,
+        progressbar=False,
+        quick_mode=False,
+        dry_run=False,
+        state=None,
+        incremental=False,
+        conditional_requests=False,
+        domain=None,
+        workers=None,
+        unordered=False,
+        concurrency=None,
+        bulk=False,
+        metadata_ttl=None,
+        cache_backend="redis",
     ):
         self.source = source
         self.reverse_geocode = reverse_geocode
@@ -35,11 +70,35 @@ class AbstractLuftdatenPumpe:
         self.progressbar = progressbar
         self.filter = filter
 
+        # Persist state between invocations.
+        self.state = state
+        self.pending_state = {}
+
+        # Incremental mode only processes data newer than on previous invocations.
+        self.incremental = incremental
+
+        # Conditional requests skip processing when upstream data has not been modified.
+        self.conditional_requests = conditional_requests
+        self.domain = domain
+
         # Quick mode only imports the first few datasets to speed things up.
         self.quick_mode = quick_mode
 
-        # Cache responses from the luftdaten.info API for five minutes.
-        # TODO: Make backend configurable.
+        # Decode archive files using a pool of worker processes, optionally yielding results out of order.
+        self.workers = workers
+        self.unordered = unordered
+
+        # Number of concurrent HTTP requests.
+        self.concurrency = concurrency or 1
+
+        # Request data of multiple timeseries at once.
+        self.bulk = bulk
+
+        # Cache station metadata for given number of seconds.
+        self.metadata_ttl = metadata_ttl
+
+        # When running a staged pipeline, or enriching in batches, station enrichment is carried out by its own stage.
+        self.enrichment_deferred = False
 
         # Configure User-Agent string.
         user_agent = APP_NAME + "/" + APP_VERSION
@@ -47,14 +106,14 @@ class AbstractLuftdatenPumpe:
         # Cache all downloaded requests.
         if self.cache_enabled:
 
-            log.info(f"Using request caching, ttl={self.cache_ttl}s")
+            log.info(f'Using request caching, backend="{cache_backend}", ttl={self.cache_ttl}s')
 
             # Use hostname of url as cache prefix.
             cache_name = urlparse(self.uri).netloc
 
             # Configure cached requests session.
             self.session = CachedSession(
-                cache_name=cache_name, backend="redis", expire_after=self.cache_ttl, user_agent=user_agent
+                **requests_cache_backend(cache_backend, cache_name), expire_after=self.cache_ttl, user_agent=user_agent
             )
 
         # Disable request cache by using a vanilla requests session.
@@ -63,8 +122,19 @@ class AbstractLuftdatenPumpe:
             self.session = requests.Session()
             self.session.headers.update({"User-Agent": user_agent})
 
+        # Keep a pool of connections alive for concurrent requests, and retry failed requests.
+        retry = Retry(
+            total=self.http_retries,
+            backoff_factor=self.http_backoff_factor,
+            status_forcelist=[429, 500, 502, 503, 504],
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_maxsize=max(self.concurrency, 10), max_retries=retry)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
         # Gracefully probe Redis for availability if cache is enabled.
-        if hasattr(self.session, "cache"):
+        if hasattr(self.session, "cache") and cache_backend == "redis":
             try:
                 self.session.cache.responses.get("test")
             except redis.exceptions.ConnectionError as ex:
@@ -88,18 +158,208 @@ class AbstractLuftdatenPumpe:
 
         return data
 
+    def load_state(self, namespace):
+        """
+        Load state persisted by previous invocations.
+        """
+        if self.state is None:
+            return {}
+        return self.state.load(f"{self.network}:{namespace}")
+
+    def domain_namespace(self, namespace):
+        """
+        Qualify a state namespace by data domain, because the stations and
+        readings domains are acquired from the same upstream data independently.
+        """
+        if self.domain is None:
+            return namespace
+        return f"{namespace}:{self.domain}"
+
+    def stage_state(self, namespace, key, value):
+        """
+        Record state to be persisted on ``commit``.
+        """
+        namespace = f"{self.network}:{namespace}"
+        self.pending_state.setdefault(namespace, {})[key] = value
+
+    def commit(self):
+        """
+        Persist recorded state. This is invoked after all data has been
+        emitted and flushed to the data sinks successfully.
+        """
+        if self.state is None:
+            return
+        for namespace, mapping in self.pending_state.items():
+            log.info(f'Persisting {len(mapping)} state items to namespace "{namespace}"')
+            self.state.update(namespace, mapping)
+        self.pending_state = {}
+
+    def discard(self):
+        """
+        Drop recorded state. This is invoked when emitting or flushing data
+        failed, so that subsequent invocations will not persist it.
+        """
+        self.pending_state = {}
+
+    def http_get(self, url, conditional=False, **kwargs):
+        """
+        Issue an HTTP GET request.
+
+        When conditional requests are enabled, the validators of successful
+        responses (``ETag`` and ``Last-Modified``) are recorded, to be persisted
+        on ``commit``. With ``conditional=True``, the validators of the previous
+        response are sent along, and ``NotModified`` is raised on HTTP 304.
+        """
+        if not self.conditional_requests:
+            return self.session.get(url, **kwargs)
+
+        # Validators are recorded per data domain and full URL.
+        namespace = self.domain_namespace("http-validators")
+        key = requests.Request("GET", url, params=kwargs.get("params")).prepare().url
+
+        headers = dict(kwargs.pop("headers", None) or {})
+        if conditional and self.state is not None:
+            validators = self.state.get(f"{self.network}:{namespace}", key) or {}
+            if "etag" in validators:
+                headers["If-None-Match"] = validators["etag"]
+            if "last-modified" in validators:
+                headers["If-Modified-Since"] = validators["last-modified"]
+
+        response = self.session.get(url, headers=headers, **kwargs)
+
+        if response.status_code == 304:
+            response.close()
+            log.info(f"Data at {key} has not been modified since previous invocation")
+            raise NotModified(key)
+
+        if response.status_code == 200:
+            validators = {}
+            if "ETag" in response.headers:
+                validators["etag"] = response.headers["ETag"]
+            if "Last-Modified" in response.headers:
+                validators["last-modified"] = response.headers["Last-Modified"]
+            if validators:
+                self.stage_state(namespace, key, validators)
+
+        return response
+
+    def derive_stations(self, readings):
+        """
+        Derive stations and their sensors from readings, recording each sensor
+        only once per station. Stations are yielded sorted by station identifier,
+        once the readings are exhausted.
+
+        Sensors are identified by ``sensor_keys`` and described by ``make_sensor``.
+        """
+
+        stations = {}
+        station_sensors = {}
+        field_candidates = ["station_id", "name", "position", "location"]
+        for reading in readings:
+
+            station_id = reading.station.station_id
+
+            # New station found: Acquire its information from the reading itself.
+            if station_id not in stations:
+                station = Munch()
+                for field in field_candidates:
+                    if field in reading.station:
+                        station[field] = reading.station[field]
+                station.sensors = []
+
+                # Record station.
+                stations[station_id] = station
+                station_sensors[station_id] = set()
+
+            # Use recorded station.
+            station = stations[station_id]
+            sensors = station_sensors[station_id]
+
+            # Deduce sensor information from the reading itself, not listing sensors twice.
+            for observation in reading.observations:
+                for key in self.sensor_keys(observation):
+                    if key not in sensors:
+                        sensors.add(key)
+                        station.sensors.append(self.make_sensor(observation, key))
+
+        # List of stations sorted by station identifier.
+        for station_id in sorted(stations):
+            yield stations[station_id]
+
+    def sensor_keys(self, observation):
+        raise NotImplementedError(f'Deriving stations not implemented by sensor network adapter "{self.network}".')
+
+    def make_sensor(self, observation, key):
+        raise NotImplementedError(f'Deriving stations not implemented by sensor network adapter "{self.network}".')
+
     def get_readings_from_api(self):
         raise NotImplementedError(f'Readings not implemented by sensor network adapter "{self.network}".')
 
     def get_readings_from_csv(self):
         raise NotImplementedError(f'Readings not implemented by sensor network adapter "{self.network}".')
 
+    def enrich_item(self, item):
+        """
+        Enrich station information of a reading or a station.
+        This is used as a processing stage of a staged pipeline.
+        """
+        station = item.station if "station" in item else item
+        self.apply_enrichment(station)
+        return item
+
     def enrich_station(self, station):
 
+        # Defer enrichment to a separate pipeline stage.
+        if self.enrichment_deferred:
+            return
+
+        self.apply_enrichment(station)
+
+    def enrich_batch(self, items, workers=1):
+        """
+        Enrich station information of readings or stations in batches.
+
+        Reverse geocoding the distinct positions of each batch is carried
+        out concurrently, using a pool of worker threads.
+        """
+        items = iter(items)
+        while True:
+            batch = list(islice(items, self.geocoding_batch_size))
+            if not batch:
+                break
+            stations = [item.station if "station" in item else item for item in batch]
+
+            locations = None
+            if self.reverse_geocode:
+                positions = [self.station_position(station) for station in stations if self.has_position(station)]
+                locations = resolve_locations(positions, workers=workers)
+
+            for station in stations:
+                self.apply_enrichment(station, locations=locations)
+
+            yield from batch
+
+    @staticmethod
+    def has_position(station):
+        return not (
+            ("latitude" not in station.position or "longitude" not in station.position)
+            or (station.position.latitude is None or station.position.longitude is None)
+        )
+
+    @staticmethod
+    def station_position(station):
+        return station.position.latitude, station.position.longitude, station.position.get("country")
+
+    def apply_enrichment(self, station, locations=None):
+        """
+        Compute geohash and, optionally, human readable location name of station.
+
+        ``locations`` may map positions to locations already reverse-geocoded,
+        or to the exception raised when reverse geocoding failed.
+        """
+
         # Sanity checks.
-        if ("latitude" not in station.position or "longitude" not in station.position) or (
-            station.position.latitude is None or station.position.longitude is None
-        ):
+        if not self.has_position(station):
 
             # Just emit this message once per station.
             StationGeocodingFailed.emit_warning(station.station_id)
@@ -113,13 +373,19 @@ class AbstractLuftdatenPumpe:
 
             try:
 
-                # Reverse-geocode position.
-                station.location = resolve_location(
-                    latitude=station.position.latitude,
-                    longitude=station.position.longitude,
-                    geohash=station.position.geohash,
-                    country_code=station.position.get("country"),
-                )
+                # Reverse-geocode position, or use location resolved upfront.
+                if locations is None:
+                    station.location = resolve_location(
+                        latitude=station.position.latitude,
+                        longitude=station.position.longitude,
+                        geohash=station.position.geohash,
+                        country_code=station.position.get("country"),
+                    )
+                else:
+                    location = locations[self.station_position(station)]
+                    if isinstance(location, Exception):
+                        raise location
+                    station.location = deepcopy(location)
 
                 # Improve location information.
                 improve_location(station.location)
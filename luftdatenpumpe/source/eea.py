@@ -3,18 +3,51 @@
 # (c) 2019 Richard Pobering <richard@hiveeyes.org>
 # (c) 2019 Matthias Mehldau <wetter@hiveeyes.org>
 # License: GNU Affero General Public License, Version 3
+import io
 import logging
+from contextlib import nullcontext
+from datetime import datetime
 from operator import itemgetter
 from urllib.parse import urljoin
 
-from munch import munchify
-from tablib import Dataset
+import pandas
+from munch import Munch
 
-from luftdatenpumpe.source.common import AbstractLuftdatenPumpe
+from luftdatenpumpe.source.common import AbstractLuftdatenPumpe, NotModified
 
 log = logging.getLogger(__name__)
 
 
+# CSV columns holding station information, in addition to the station keys.
+STATION_COLUMNS = [
+    "Namespace",
+    "AirQualityStation",
+    "AirQualityStationNatCode",
+    "AirQualityStationType",
+    "AirQualityStationArea",
+    "Latitude",
+    "Longitude",
+    "Altitude",
+    "Projection",
+    "BuildingDistance",
+    "KerbDistance",
+]
+
+# Mapping of sensor attributes to CSV columns.
+SENSOR_COLUMNS = {
+    # FIXME: Compute `AirPollutant` from `AirPollutantCode`.
+    #        The original field was decommissioned.
+    "sensor_type_uri": "AirPollutantCode",
+    "sensor_measurement_type": "MeasurementType",
+    "sensor_measurement_equipment": "MeasurementEquipment",
+    "sensor_inlet_height": "InletHeight",
+    "sensor_equivalence_demonstrated": "EquivalenceDemonstrated",
+    "sensor_sampling_process": "SamplingProces",
+    "sensor_sampling_id": "Sample",
+    "sensor_sampling_point": "SamplingPoint",
+}
+
+
 class EEAAirQualityPumpe(AbstractLuftdatenPumpe):
     """
     Ingest air quality measurements from the European Environment Agency (EEA).
@@ -48,15 +81,28 @@ class EEAAirQualityPumpe(AbstractLuftdatenPumpe):
     cache_enabled = True
     cache_ttl = 3000
 
+    # Bulk download service for air quality measurements, per country and pollutant.
+    download_uri = "https://fme.discomap.eea.europa.eu/fmedatastreaming/AirQualityDownload/AQData_Extract.fmw"
+
+    # Acquire up-to-date, unvalidated measurements.
+    download_source = "E2a"
+
+    # Pollutants to acquire readings for, by pollutant code.
+    # https://dd.eionet.europa.eu/vocabulary/aq/pollutant
+    pollutants = (1, 5, 7, 8, 10, 6001)
+
+    # Number of rows to decode at once when streaming bulk download files.
+    chunksize = 50000
+
     def get_index(self):
         return self.send_request()
 
-    def send_request(self, endpoint=None, params=None):
+    def send_request(self, endpoint=None, params=None, conditional=False):
         url = urljoin(self.uri, endpoint)
         log.info(f"Requesting station list from EEA at {url}")
         params = params or {}
 
-        response = self.session.get(url, params=params, timeout=self.timeout)
+        response = self.http_get(url, conditional=conditional, params=params, timeout=self.timeout)
         if response.status_code != 200:
             try:
                 reason = response.json()
@@ -68,7 +114,7 @@ class EEAAirQualityPumpe(AbstractLuftdatenPumpe):
 
         return response.text
 
-    def get_stations(self):
+    def get_stations(self, conditional=True, enrich=True):
         """
         1. Example ingress record - 2019
            URL: https://ereporting.blob.core.windows.net/downloadservice/metadata.csv
@@ -136,85 +182,78 @@ class EEAAirQualityPumpe(AbstractLuftdatenPumpe):
             }
         """
 
-        payload = self.send_request("metadata/PanEuropean_metadata.csv")
+        try:
+            payload = self.send_request("metadata/PanEuropean_metadata.csv", conditional=conditional)
+        except NotModified:
+            return []
 
-        # Read CSV file into tablib's Dataset and cast to dictionary representation.
+        # Read CSV file into a data frame, keeping all values as strings.
         try:
-            data = Dataset().load(payload, format="csv", delimiter="\t")
+            df = pandas.read_csv(io.StringIO(payload), sep="\t", dtype=str, keep_default_na=False)
         except:  # noqa:E722
             log.exception("Error reading or decoding station CSV")
             return
 
         # Apply data filter.
-        data = self.apply_filter(data)
+        df = self.apply_filter(df)
+
+        # Convert numeric columns in bulk. Missing or invalid values become `None`.
+        for column in ["Latitude", "Longitude", "Altitude", "BuildingDistance", "KerbDistance", "InletHeight"]:
+            values = pandas.to_numeric(df[column], errors="coerce").astype(float)
+            df[column] = values.astype(object).where(values.notna(), None)
+
+        # Collect sensors, i.e. sampling points, per station, from column arrays.
+        station_keys = ["Countrycode", "AirQualityNetwork", "AirQualityStationEoICode"]
+        sensors = {}
+        for key, *values in zip(zip(*self.columns(df, station_keys)), *self.columns(df, SENSOR_COLUMNS.values())):
+            sensors.setdefault(key, []).append(Munch(zip(SENSOR_COLUMNS.keys(), values)))
 
-        df_grouped = data.df.groupby(["Countrycode", "AirQualityNetwork", "AirQualityStationEoICode"], as_index=False)
+        # Use the first sampling point of each station for station information.
+        df_stations = df.drop_duplicates(station_keys).sort_values(station_keys, kind="stable")
+        records = zip(*self.columns(df_stations, station_keys + STATION_COLUMNS))
 
         stations = []
-        for name, group in self.wrap_progress(df_grouped):
-            first_sensor = group.head(1)
-            data = first_sensor.to_dict(orient="records")[0]
-            log.debug("Ingress data: %s", data)
-
-            station_eoi_code = data.pop("AirQualityStationEoICode")
-            station_info = munchify(
-                {
-                    "station_id": station_eoi_code,
-                    "station_namespace": data.pop("Namespace"),
-                    "station_network_code": data.pop("AirQualityNetwork"),
-                    "station_code": data.pop("AirQualityStation"),
-                    "station_nat_code": data.pop("AirQualityStationNatCode"),
-                    "station_eoi_code": station_eoi_code,
-                    "station_type": data.pop("AirQualityStationType"),
-                    "station_area": data.pop("AirQualityStationArea"),
-                    "position": {
-                        "country": data.pop("Countrycode"),
-                        "latitude": float(data.pop("Latitude")),
-                        "longitude": float(data.pop("Longitude")),
-                        "altitude": float(data.pop("Altitude")),
-                        "projection": data.pop("Projection"),
-                        "building_distance": float(data.pop("BuildingDistance")),
-                        "kerb_distance": float(data.pop("KerbDistance")),
-                    },
-                }
+        for record in self.wrap_progress(records):
+            (
+                country,
+                network_code,
+                station_eoi_code,
+                namespace,
+                station_code,
+                station_nat_code,
+                station_type,
+                station_area,
+                latitude,
+                longitude,
+                altitude,
+                projection,
+                building_distance,
+                kerb_distance,
+            ) = record
+            station_info = Munch(
+                station_id=station_eoi_code,
+                station_namespace=namespace,
+                station_network_code=network_code,
+                station_code=station_code,
+                station_nat_code=station_nat_code,
+                station_eoi_code=station_eoi_code,
+                station_type=station_type,
+                station_area=station_area,
+                position=Munch(
+                    country=country,
+                    latitude=latitude,
+                    longitude=longitude,
+                    altitude=altitude,
+                    projection=projection,
+                    building_distance=building_distance,
+                    kerb_distance=kerb_distance,
+                ),
             )
-            # print(data)
-
-            # Transfer all other stuff.
-            # for key, value in data.items():
-            #    station_info[key] = value
-
-            # print('station_info:', station_info)
-            # continue
-
-            self.enrich_station(station_info)
-
-            # FIXME: Add sensors.
-            sensors = []
-            for measurement in group.to_dict(orient="records"):
-                # print('measurement:', measurement)
-                # data = measurement.to_dict(orient='records')[0]
-                # log.info('Sensor data: %s', json.dumps(measurement, indent=2))
-                sensor_info = munchify(
-                    {
-                        # FIXME: Compute `AirPollutant` from `AirPollutantCode`.
-                        #        The original field was decommissioned.
-                        # "sensor_type": measurement.pop("AirPollutant"),
-                        "sensor_type_uri": measurement.pop("AirPollutantCode"),
-                        "sensor_measurement_type": measurement.pop("MeasurementType"),
-                        # "sensor_measurement_method": measurement.pop("MeasurementMethod"),
-                        "sensor_measurement_equipment": measurement.pop("MeasurementEquipment"),
-                        "sensor_inlet_height": float(measurement.pop("InletHeight")),
-                        "sensor_equivalence_demonstrated": measurement.pop("EquivalenceDemonstrated"),
-                        "sensor_sampling_process": measurement.pop("SamplingProces"),
-                        "sensor_sampling_id": measurement.pop("Sample"),
-                        "sensor_sampling_point": measurement.pop("SamplingPoint"),
-                    }
-                )
-                sensors.append(sensor_info)
-
-            station_info.sensors = sensors
 
+            if enrich:
+                self.enrich_station(station_info)
+
+            station_info.sensors = sensors[record[:3]]
             stations.append(station_info)
 
         # List of stations sorted by station identifier.
@@ -222,10 +261,186 @@ class EEAAirQualityPumpe(AbstractLuftdatenPumpe):
 
         return stations
 
-    def filter_rule(self, data):
-        df_filtered = data.df
-        if self.filter and "country" in self.filter:
-            df_filtered = df_filtered[df_filtered["Countrycode"].isin(self.filter.country)]
+    def get_readings_from_api(self):
+        """
+        Acquire readings from the bulk download service, per country and pollutant.
+
+        Bulk download files are streamed and decoded in chunks, so memory usage is
+        bounded by the chunk size, independently of the file size. Measurements
+        are joined against the station metadata by sampling point, yielding one
+        item per station and chunk. Only stations having measurements are enriched.
+
+        In incremental mode, measurements not newer than the cursor of their
+        sampling point, as recorded by previous invocations, are skipped.
+
+        Items look like::
+
+          {
+            "station": {
+              "station_id": "AD0942A",
+              "position": {...}
+            },
+            "observations": [
+              {
+                "meta": {
+                  "timestamp": "2022-03-01T10:00:00+01:00"
+                },
+                "data": {
+                  "no2": 12.4
+                }
+              }
+            ]
+          }
+
+        """
 
-        data.df = df_filtered
-        return data
+        # Map sampling points to their stations.
+        station_map = {}
+        countries = set()
+        self.enriched = set()
+        for station in self.get_stations(conditional=False, enrich=False) or []:
+            item_station = Munch(station)
+            del item_station["sensors"]
+            for sensor in station.sensors:
+                station_map[sensor.sensor_sampling_point] = item_station
+            countries.add(station.position.country)
+
+        self.cursors = {}
+        self.newest = {}
+        if self.incremental:
+            self.cursors = self.load_state(self.domain_namespace("cursors"))
+            log.info(f"Loaded cursors for {len(self.cursors)} sampling points")
+
+        year = datetime.now().year
+        for country in sorted(countries):
+            for pollutant in self.pollutants:
+                for url in self.get_download_urls(country, pollutant, year):
+                    yield from self.read_download_file(url, station_map)
+
+    def get_download_urls(self, country, pollutant, year):
+        """
+        Request the list of bulk download files for the given country, pollutant and year.
+        """
+        params = {
+            "CountryCode": country,
+            "CityName": "",
+            "Pollutant": pollutant,
+            "Year_from": year,
+            "Year_to": year,
+            "Station": "",
+            "Samplingpoint": "",
+            "Source": self.download_source,
+            "Output": "TEXT",
+            "UpdateDate": "",
+            "TimeCoverage": "Year",
+        }
+        log.info(f"Requesting list of download files from EEA for country={country}, pollutant={pollutant}")
+        response = self.http_get(self.download_uri, params=params, timeout=self.timeout)
+        response.raise_for_status()
+        return [line.strip() for line in response.text.lstrip("\ufeff").splitlines() if line.strip()]
+
+    def read_download_file(self, url, station_map):
+        """
+        Stream a bulk download file and decode it in chunks.
+
+        The request cache is bypassed, as it would hold the whole file in memory.
+        """
+        log.info(f"Reading measurements from {url}")
+        cache_disabled = getattr(self.session, "cache_disabled", nullcontext)
+        try:
+            with cache_disabled():
+                response = self.http_get(url, conditional=True, stream=True, timeout=self.timeout)
+        except NotModified:
+            return
+        response.raise_for_status()
+        response.raw.decode_content = True
+
+        try:
+            chunks = pandas.read_csv(
+                response.raw,
+                usecols=["SamplingPoint", "AirPollutant", "Concentration", "DatetimeBegin", "Validity"],
+                dtype=str,
+                keep_default_na=False,
+                encoding="utf-8-sig",
+                chunksize=self.chunksize,
+            )
+            for df in chunks:
+                yield from self.readings_from_chunk(df, station_map)
+        finally:
+            response.close()
+
+    def readings_from_chunk(self, df, station_map):
+        """
+        Join a chunk of measurements against the station metadata by sampling point,
+        grouping observations by station. Invalid measurements are skipped.
+        """
+        df = df.assign(
+            Concentration=pandas.to_numeric(df["Concentration"], errors="coerce"),
+            Validity=pandas.to_numeric(df["Validity"], errors="coerce"),
+        )
+        df = df[df["Concentration"].notna() & (df["Validity"] >= 1)]
+
+        # Sampling points are prefixed by their namespace, e.g. "AD/SPO-AD0942A-0001".
+        sampling_points = df["SamplingPoint"].str.rpartition("/")[2]
+        known = sampling_points.isin(station_map.keys())
+        if not known.all():
+            unknown = sampling_points[~known].nunique()
+            log.debug(f"Skipping measurements of {unknown} sampling points without station metadata")
+        df, sampling_points = df[known], sampling_points[known]
+
+        if self.incremental:
+            df = self.skip_processed(df)
+            sampling_points = sampling_points[df.index]
+
+        items = {}
+        timestamps = {}
+        columns = self.columns(df, ["AirPollutant", "Concentration", "DatetimeBegin"])
+        for sampling_point, pollutant, value, timestamp in zip(sampling_points.tolist(), *columns):
+            station = station_map[sampling_point]
+
+            # Format each distinct timestamp only once, e.g. "2022-03-01 10:00:00 +01:00".
+            if timestamp not in timestamps:
+                timestamps[timestamp] = timestamp.replace(" ", "T", 1).replace(" ", "")
+
+            if station.station_id not in items:
+                if station.station_id not in self.enriched:
+                    self.enrich_station(station)
+                    self.enriched.add(station.station_id)
+                items[station.station_id] = Munch(station=station, observations=[])
+            items[station.station_id].observations.append(
+                Munch(meta=Munch(timestamp=timestamps[timestamp]), data=Munch({pollutant.lower(): value}))
+            )
+
+        return items.values()
+
+    def skip_processed(self, df):
+        """
+        Skip measurements not newer than the cursor of their sampling point, as
+        recorded by previous invocations. Record the timestamps of the newest
+        measurements, in milliseconds, to be persisted after the data has been
+        flushed to the data sinks.
+        """
+        timestamps = pandas.to_datetime(df["DatetimeBegin"], format="%Y-%m-%d %H:%M:%S %z", utc=True, errors="coerce")
+        timestamps = (timestamps - pandas.Timestamp(0, tz="UTC")) // pandas.Timedelta(milliseconds=1)
+        cursors = df["SamplingPoint"].map(self.cursors).fillna(-1)
+        df, timestamps = df[timestamps > cursors], timestamps[timestamps > cursors]
+
+        namespace = self.domain_namespace("cursors")
+        for sampling_point, newest in timestamps.groupby(df["SamplingPoint"]).max().items():
+            if newest > self.newest.get(sampling_point, -1):
+                self.newest[sampling_point] = int(newest)
+                self.stage_state(namespace, sampling_point, int(newest))
+
+        return df
+
+    @staticmethod
+    def columns(df, names):
+        """
+        Return the values of the given data frame columns as lists of Python objects.
+        """
+        return [df[name].tolist() for name in names]
+
+    def filter_rule(self, df):
+        if self.filter and "country" in self.filter:
+            df = df[df["Countrycode"].isin(self.filter.country)]
+        return df
@@ -3,18 +3,21 @@
 # (c) 2017-2019 Richard Pobering <richard@hiveeyes.org>
 # (c) 2019 Matthias Mehldau <wetter@hiveeyes.org>
 # License: GNU Affero General Public License, Version 3
+import heapq
 import logging
+import time
 from collections import OrderedDict
-from copy import deepcopy
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+from itertools import groupby
 from operator import itemgetter
 from urllib.parse import urljoin
 
 from munch import Munch, munchify
-from requests import HTTPError
+from requests import HTTPError, RequestException
 from rfc3339 import rfc3339
 
-from luftdatenpumpe.source.common import AbstractLuftdatenPumpe
+from luftdatenpumpe.source.common import AbstractLuftdatenPumpe, NotModified
 from luftdatenpumpe.util import slugify
 
 log = logging.getLogger(__name__)
@@ -47,15 +50,30 @@ class IrcelinePumpe(AbstractLuftdatenPumpe):
 
     timeout = 60
 
+    # Number of timeseries per bulk request, adjusted adaptively.
+    bulk_chunk_size = 100
+    bulk_chunk_size_max = 1000
+
+    # Bulk requests taking less than this number of seconds will grow the chunk size,
+    # those taking more than twice as long will shrink it.
+    bulk_duration = 10
+
+    # In incremental mode, do not request values older than this number of hours,
+    # so that a single timeseries lagging behind will not inflate the timespan of all others.
+    max_timespan_hours = 48
+
     def get_index(self):
         return self.send_request()
 
-    def send_request(self, endpoint=None, params=None):
+    def send_request(self, endpoint=None, params=None, conditional=False, payload=None):
         url = urljoin(self.uri, endpoint)
         log.debug(f"Requesting IRCELINE live API at {url}")
         params = params or {}
 
-        response = self.session.get(url, params=params, timeout=self.timeout)
+        if payload is None:
+            response = self.http_get(url, conditional=conditional, params=params, timeout=self.timeout)
+        else:
+            response = self.session.post(url, params=params, json=payload, timeout=self.timeout)
         if response.status_code != 200:
             try:
                 reason = response.json()
@@ -67,15 +85,28 @@ class IrcelinePumpe(AbstractLuftdatenPumpe):
 
         return response.json()
 
-    def get_stations(self):
+    def get_stations(self, timeseries_index=None):
         """
         http://geo.irceline.be/sos/api/v1/stations/?service=1&expand=true&locale=en
         """
 
-        data = self.send_request("stations", params={"expanded": "true"})
-        # import sys, json; print(json.dumps(data, indent=2)); sys.exit(0)
+        if timeseries_index is None:
 
-        timeseries_index = self.get_timeseries_index()
+            # With conditional requests, skip processing when neither the list
+            # of stations nor the timeseries index have been modified.
+            try:
+                timeseries_index = self.get_timeseries_index(conditional=True)
+                data = self.send_request("stations", params={"expanded": "true"})
+            except NotModified:
+                try:
+                    data = self.send_request("stations", params={"expanded": "true"}, conditional=True)
+                except NotModified:
+                    return []
+                timeseries_index = self.get_timeseries_index()
+
+        else:
+            data = self.send_request("stations", params={"expanded": "true"})
+        # import sys, json; print(json.dumps(data, indent=2)); sys.exit(0)
         # import sys, json; print(json.dumps(timeseries_index, indent=2)); sys.exit(0)
 
         # Apply data filter.
@@ -118,13 +149,99 @@ class IrcelinePumpe(AbstractLuftdatenPumpe):
         # List of stations sorted by station identifier.
         stations = sorted(stations, key=itemgetter("station_id"))
 
+        # Refresh the metadata cache with the complete and enriched list of stations.
+        if self.metadata_ttl and self.state is not None and not self.filtered and not self.enrichment_deferred:
+            self.store_metadata(stations, timeseries_index)
+
         return stations
 
-    def filter_rule(self, data):
+    @property
+    def filtered(self):
+        return bool(self.filter) and any(name in self.filter for name in ["country", "station", "sensor"])
 
+    def get_station_metadata(self, timeseries_index=None):
+        """
+        Get stations including their sensors, using the metadata cache if enabled.
+
+        The cache expires after ``metadata_ttl`` seconds. It is invalidated when
+        the timeseries index lists unknown timeseries, or when the reverse geocoding
+        option differs. Acquiring stations without filter refreshes the cache.
+        """
+        if self.metadata_ttl and self.state is not None:
+            stations = self.load_metadata(timeseries_index)
+            if stations is not None:
+                return list(self.filter_stations(stations))
+        return self.get_stations(timeseries_index=timeseries_index)
+
+    def load_metadata(self, timeseries_index=None):
+        info = self.state.get(f"{self.network}:metadata", "info")
+        if info is None:
+            return None
+
+        age = time.time() - info["updated"]
+        if age > self.metadata_ttl:
+            log.info(f"Metadata cache expired after {age:.0f}s")
+            return None
+
+        if info["reverse-geocode"] != self.reverse_geocode:
+            log.info("Metadata cache does not match reverse geocoding option")
+            return None
+
+        if timeseries_index is not None:
+            known = set(map(int, self.load_state("metadata:timeseries")))
+            unknown = set(timeseries_index) - known
+            if unknown:
+                log.info(f"Metadata cache lacks {len(unknown)} timeseries")
+                return None
+
+        stations = self.load_state("metadata:stations")
+        log.info(f"Using cached metadata of {len(stations)} stations")
+        return [munchify(stations[key]) for key in sorted(stations, key=int)]
+
+    def store_metadata(self, stations, timeseries_index):
+        log.info(f"Caching metadata of {len(stations)} stations")
+
+        # Record all timeseries listed by the index, also those not associated with any station.
+        timeseries = {timeseries_id: None for timeseries_id in timeseries_index}
+        for station in stations:
+            for sensor in station.sensors:
+                timeseries[sensor["sensor_id"]] = station.station_id
+
+        for namespace, mapping in [
+            ("metadata:stations", {station.station_id: station for station in stations}),
+            ("metadata:timeseries", timeseries),
+        ]:
+            namespace = f"{self.network}:{namespace}"
+            self.state.purge(namespace)
+            self.state.update(namespace, mapping)
+        self.state.update(
+            f"{self.network}:metadata", {"info": {"updated": time.time(), "reverse-geocode": self.reverse_geocode}}
+        )
+
+    def filter_stations(self, stations):
+        """
+        Apply data filter to cached stations, like ``filter_rule`` does to upstream data.
+        """
+        self.check_country_filter()
+        for station in stations:
+            if self.filter and "station" in self.filter and station.station_id not in self.filter["station"]:
+                continue
+            if (
+                self.filter
+                and "sensor" in self.filter
+                and not any(sensor["sensor_id"] in self.filter["sensor"] for sensor in station.sensors)
+            ):
+                continue
+            yield station
+
+    def check_country_filter(self):
         if self.filter and "country" in self.filter and self.filter.country != ["BE"]:
             raise NotImplementedError("Filtering by country not supported for IRCELINE/SOS, it's Belgium at all.")
 
+    def filter_rule(self, data):
+
+        self.check_country_filter()
+
         for item in data:
 
             # log.info('item: %s', item)
@@ -297,10 +414,19 @@ class IrcelinePumpe(AbstractLuftdatenPumpe):
         """
         timeseries_id_list = []
 
+        # Acquire the timeseries index, unless using cached metadata only.
+        # With conditional requests, skip processing when it has not been modified.
+        timeseries_index = None
+        if self.conditional_requests or self.incremental or not self.metadata_ttl:
+            try:
+                timeseries_index = self.get_timeseries_index(conditional=True)
+            except NotModified:
+                return []
+
         # Map stations and timeseries to their sensors.
         station_map = {}
         timeseries_sensor_map = {}
-        for station in self.get_stations():
+        for station in self.get_station_metadata(timeseries_index=timeseries_index):
             station_id = station.station_id
             station_map[station_id] = station
 
@@ -321,56 +447,65 @@ class IrcelinePumpe(AbstractLuftdatenPumpe):
         # Fails
         # timeseries = self.get_timeseries(timeseries_ids=[1180, 6895], timespan=self.filter.get('timespan'))
 
+        # Optionally, only request timeseries with values newer than those processed by previous invocations.
+        timespan = self.filter.get("timespan")
+        if self.incremental:
+            timeseries_id_list, timespan = self.select_unprocessed(timeseries_id_list, timeseries_index, timespan)
+
         # For real
-        timeseries = self.get_timeseries_details(
-            timeseries_ids=timeseries_id_list, timespan=self.filter.get("timespan")
-        )
+        timeseries = self.get_timeseries_details(timeseries_ids=timeseries_id_list, timespan=timespan)
 
-        # Map timeseries to readings.
-        timeseries_readings_map = {}
+        # Map timeseries to their values, as pairs of timestamp in milliseconds and value, sorted by timestamp.
+        timeseries_values_map = {}
         for tsid, item in timeseries.items():
             # print(tsid, item)
             timeseries_id = int(tsid)
-            fieldname = timeseries_sensor_map[timeseries_id]["sensor_fieldname"]
-            data = self.reading_data_from_timeseries(fieldname, item["values"])
-            data = list(data)
+            values = item["values"]
+            if self.incremental:
+                values = self.skip_processed(timeseries_id, values)
+            data = sorted(self.reading_data_from_timeseries(values))
             # TODO: Emit warning here if station has no data whatsoever?
             if not data:
                 continue
-            timeseries_readings_map[timeseries_id] = data
+            timeseries_values_map[timeseries_id] = data
 
         # Make readings for all stations, grouping by timestamp.
+        requested = set(timeseries_id_list)
+        timestamps = {}
         items = []
         for station_id in sorted(station_map.keys()):
             station = station_map[station_id]
-            all_data = []
-            for sensor in station.sensors:
+
+            # Columns of values per timeseries, labelled by sensor.
+            columns = []
+            for index, sensor in enumerate(station.sensors):
 
                 timeseries_id = sensor["sensor_id"]
-                if timeseries_id not in timeseries_readings_map:
-                    log.warning(f'Station "{station_id}" has no data for timeseries "{timeseries_id}"')
+                if timeseries_id not in timeseries_values_map:
+                    if timeseries_id in requested:
+                        log.warning(f'Station "{station_id}" has no data for timeseries "{timeseries_id}"')
                     continue
 
-                all_data += timeseries_readings_map[timeseries_id]
-
-            item_station = deepcopy(station)
-            del item_station["sensors"]
-
-            # Group by timestamp.
-            timestamp_data_map = {}
-            for data_item in all_data:
-                timestamp = data_item["timestamp"]
-                # del data_item['timestamp']
-                timestamp_data_map.setdefault(timestamp, {})
-                timestamp_data_map[timestamp].update(data_item)
+                fieldname = sensor["sensor_fieldname"]
+                columns.append(
+                    [(timestamp, index, fieldname, value) for timestamp, value in timeseries_values_map[timeseries_id]]
+                )
 
-            # Build list of observations.
+            # Merge the sorted columns, grouping values by timestamp.
+            # Format each distinct timestamp only once.
             observations = []
-            for data in sorted(timestamp_data_map.values(), key=itemgetter("timestamp")):
-                timestamp = data["timestamp"]
-                del data["timestamp"]
-                observation = munchify(dict(meta={"timestamp": timestamp}, data=data))
-                observations.append(observation)
+            for timestamp, group in groupby(heapq.merge(*columns), key=itemgetter(0)):
+                if timestamp not in timestamps:
+                    timestamps[timestamp] = self.convert_timestamp(timestamp)
+                data = Munch((fieldname, value) for _, _, fieldname, value in group)
+                observations.append(Munch(meta=Munch(timestamp=timestamps[timestamp]), data=data))
+
+            # In incremental mode, skip stations without new data.
+            if self.incremental and not observations:
+                continue
+
+            item_station = Munch(station)
+            del item_station["sensors"]
 
             # List of all readings by timestamp, ascending.
             item = Munch(
@@ -383,12 +518,68 @@ class IrcelinePumpe(AbstractLuftdatenPumpe):
 
         return items
 
-    def get_timeseries_index(self, timespan=None):
+    def select_unprocessed(self, timeseries_ids, timeseries_index, timespan=None):
+        """
+        Select timeseries where the timestamp of the last value reported by the
+        timeseries index is newer than the cursor recorded by previous invocations.
+
+        Unless given explicitly, compute a timespan starting at the oldest cursor of
+        all selected timeseries, but not earlier than ``max_timespan_hours`` ago.
+        Timeseries without a cursor use the default timespan.
+        """
+        self.cursors = {int(key): value for key, value in self.load_state(self.domain_namespace("cursors")).items()}
+        log.info(f"Loaded cursors for {len(self.cursors)} timeseries")
+
+        # Start of the default and of the maximum timespan, in milliseconds.
+        this_hour = self.this_hour(as_datetime=True)
+        default_start = (this_hour - timedelta(hours=12)).timestamp() * 1000
+        earliest_start = (this_hour - timedelta(hours=self.max_timespan_hours)).timestamp() * 1000
+
+        selected = []
+        starts = []
+        for timeseries_id in timeseries_ids:
+            cursor = self.cursors.get(timeseries_id)
+            if cursor is not None:
+                if timeseries_id in timeseries_index and timeseries_index[timeseries_id].lastValue.timestamp <= cursor:
+                    continue
+                starts.append(cursor)
+            else:
+                starts.append(default_start)
+            selected.append(timeseries_id)
+
+        log.info(f"Skipping {len(timeseries_ids) - len(selected)} timeseries without new values")
+
+        if timespan is None:
+            start = min(starts, default=default_start)
+            if start < earliest_start:
+                log.warning(
+                    f"Limiting timespan to {self.max_timespan_hours} hours, "
+                    "values of timeseries lagging further behind will be skipped"
+                )
+                start = earliest_start
+            timespan = f"{self.convert_timestamp(start)}/{self.this_hour()}"
+
+        return selected, timespan
+
+    def skip_processed(self, timeseries_id, values):
+        """
+        Skip values not newer than the cursor of their timeseries. Record the new
+        cursor, to be persisted after the data has been flushed to the data sinks.
+        """
+        cursor = self.cursors.get(timeseries_id)
+        if cursor is not None:
+            values = [value for value in values if value["timestamp"] > cursor]
+        if values:
+            cursor = max(value["timestamp"] for value in values)
+            self.stage_state(self.domain_namespace("cursors"), timeseries_id, cursor)
+        return values
+
+    def get_timeseries_index(self, timespan=None, conditional=False):
         if timespan is None:
             timespan = f"PT12h/{self.this_hour()}"
 
         url = urljoin(self.uri, "timeseries/")
-        data = self.send_request(url, params={"timespan": timespan, "expanded": "true"})
+        data = self.send_request(url, params={"timespan": timespan, "expanded": "true"}, conditional=conditional)
         # print(data)
 
         items = {}
@@ -433,23 +624,88 @@ class IrcelinePumpe(AbstractLuftdatenPumpe):
 
         log.info(f'Requesting IRCELINE live API with timespan "{timespan}" and {len(timeseries_ids)} timeseries')
 
+        if self.bulk:
+            return self.get_timeseries_bulk(timeseries_ids, timespan)
+
+        # Request timeseries concurrently, sharing the pooled connections of the HTTP session.
         results = {}
-        for identifier in self.wrap_progress(sorted(timeseries_ids)):
-            url = urljoin(self.uri, f"timeseries/{identifier}/getData")
-            log.debug(f"Requesting SOS timeseries {identifier} from {url}")
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            futures = [
+                executor.submit(self.get_timeseries_data, identifier, timespan) for identifier in sorted(timeseries_ids)
+            ]
             try:
-                data = self.send_request(url, params={"timespan": timespan, "expanded": "true"})
-                results.update(data)
+                for future in self.wrap_progress(futures):
+                    data = future.result()
+                    if data:
+                        results.update(data)
             except KeyboardInterrupt:
+                for future in futures:
+                    future.cancel()
                 raise
-            except HTTPError as ex:
-                log.error(f"Requesting data for timeseries {identifier} failed: {ex}")
-            except:  # noqa:E722
-                log.exception(f"Decoding response for timeseries {identifier} failed")
 
         return results
 
-    def reading_data_from_timeseries(self, name, values):
+    def get_timeseries_bulk(self, timeseries_ids, timespan):
+        """
+        Request data of multiple timeseries at once, in chunks. The chunk size
+        grows while requests are quick, and shrinks when requests are slow or fail.
+        """
+        results = {}
+        pending = sorted(timeseries_ids)
+        chunk_size = self.bulk_chunk_size
+        while pending:
+            chunk, pending = pending[:chunk_size], pending[chunk_size:]
+            started = time.monotonic()
+            success = self.get_timeseries_chunk(chunk, timespan, results)
+            duration = time.monotonic() - started
+            if not success or duration > 2 * self.bulk_duration:
+                chunk_size = max(chunk_size // 2, 1)
+            elif duration < self.bulk_duration:
+                chunk_size = min(chunk_size * 2, self.bulk_chunk_size_max)
+
+        return results
+
+    def get_timeseries_chunk(self, timeseries_ids, timespan, results):
+        """
+        Request data of a chunk of timeseries. When the request fails, bisect
+        the chunk in order to isolate failing timeseries. As POST requests are
+        not retried by the HTTP session, this also retries the remaining timeseries
+        on transient errors, like connection errors, timeouts or server errors.
+
+        Returns whether the request succeeded at once.
+        """
+        log.debug(f"Requesting SOS timeseries {timeseries_ids}")
+        try:
+            data = self.send_request(
+                "timeseries/getData",
+                params={"expanded": "true"},
+                payload={"timeseries": timeseries_ids, "timespan": timespan},
+            )
+            results.update(data)
+            return True
+
+        except RequestException as ex:
+            if len(timeseries_ids) == 1:
+                log.error(f"Requesting data for timeseries {timeseries_ids[0]} failed: {ex}")
+                return False
+
+            log.warning(f"Requesting data for {len(timeseries_ids)} timeseries failed, bisecting. Reason: {ex}")
+            middle = len(timeseries_ids) // 2
+            self.get_timeseries_chunk(timeseries_ids[:middle], timespan, results)
+            self.get_timeseries_chunk(timeseries_ids[middle:], timespan, results)
+            return False
+
+    def get_timeseries_data(self, identifier, timespan):
+        url = urljoin(self.uri, f"timeseries/{identifier}/getData")
+        log.debug(f"Requesting SOS timeseries {identifier} from {url}")
+        try:
+            return self.send_request(url, params={"timespan": timespan, "expanded": "true"})
+        except HTTPError as ex:
+            log.error(f"Requesting data for timeseries {identifier} failed: {ex}")
+        except:  # noqa:E722
+            log.exception(f"Decoding response for timeseries {identifier} failed")
+
+    def reading_data_from_timeseries(self, values):
         """
         Ingress
         =======
@@ -457,38 +713,12 @@ class IrcelinePumpe(AbstractLuftdatenPumpe):
 
             values = [{'timestamp': 1556064000000, 'value': 172.0}, {'timestamp': 1556067600000, 'value': 162.0}]
 
-        From::
-
-            {
-              "values": [
-                {
-                  "timestamp": 1556056800000,
-                  "value": 36.1
-                },
-                {
-                  "timestamp": 1556060400000,
-                  "value": 34.6
-                },
-                {
-                  "timestamp": 1556064000000,
-                  "value": 33.1
-                },
-                {
-                  "timestamp": 1556067600000,
-                  "value": 32.6
-                }
-              ]
-            }
-
         Egress
         ======
         ::
 
-            {
-              "time": "2019-04-24T00:52:32Z",
-              "P1": 4.5,
-              "P2": 3.5
-            }
+            (1556064000000, 172.0)
+            (1556067600000, 162.0)
 
         """
         for observation in values:
@@ -500,11 +730,7 @@ class IrcelinePumpe(AbstractLuftdatenPumpe):
             if value is None or str(value).lower() == "nan" or value == -99.99:
                 continue
 
-            entry = {
-                "timestamp": self.convert_timestamp(observation["timestamp"]),
-                name: value,
-            }
-            yield entry
+            yield observation["timestamp"], value
 
     @staticmethod
     def convert_timestamp(timestamp):
@@ -515,9 +741,11 @@ class IrcelinePumpe(AbstractLuftdatenPumpe):
         return rfc3339(datetime_object)
 
     @staticmethod
-    def this_hour():
+    def this_hour(as_datetime=False):
         now = datetime.now()
         now_aligned_to_hour = now - timedelta(minutes=now.minute, seconds=now.second, microseconds=now.microsecond)
+        if as_datetime:
+            return now_aligned_to_hour
         return rfc3339(now_aligned_to_hour)
 
     @staticmethod
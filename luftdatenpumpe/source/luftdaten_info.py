@@ -3,16 +3,29 @@
 # (c) 2017-2019 Richard Pobering <richard@hiveeyes.org>
 # (c) 2019 Matthias Mehldau <wetter@hiveeyes.org>
 # License: GNU Affero General Public License, Version 3
+import csv
 import json
 import logging
+import math
+import os
 import re
-from operator import itemgetter
+from itertools import chain, islice
+from multiprocessing import Pool
 
 from munch import Munch
-from tablib import Dataset
-
-from luftdatenpumpe.source.common import AbstractLuftdatenPumpe
-from luftdatenpumpe.util import find_files, is_nan
+from tqdm import tqdm
+
+from luftdatenpumpe.source.common import AbstractLuftdatenPumpe, NotModified
+from luftdatenpumpe.util import (
+    archive_file_digest,
+    archive_file_stat,
+    find_archive_files,
+    is_nan,
+    open_archive_file,
+    open_zip_bundle,
+    read_json_array,
+    strip_compression_suffix,
+)
 
 log = logging.getLogger(__name__)
 
@@ -34,65 +47,58 @@ class LuftdatenPumpe(AbstractLuftdatenPumpe):
     # Live data API URI for luftdaten.info.
     uri = "https://api.luftdaten.info/static/v1/data.json"
 
-    def get_stations(self):
-
-        stations = {}
-        field_candidates = ["station_id", "name", "position", "location"]
-        for reading in self.get_readings():
-
-            # LDI Location ID is "station_id" here.
-            station_id = reading.station.station_id
-
-            # New station found: Acquire its information from the reading itself.
-            if station_id not in stations:
-                station = Munch()
-                for field in field_candidates:
-                    if field in reading.station:
-                        station[field] = reading.station[field]
-                station.sensors = []
-
-                # Record station.
-                stations[station_id] = station
+    # Chunk size when streaming the response from the live data API.
+    chunk_size = 64 * 1024
 
-            # Use recorded station.
-            station = stations[station_id]
+    # Number of CSV files submitted to worker processes at once.
+    worker_chunksize = 8
 
-            # Deduce sensor information from the reading itself.
-            for observation in reading.observations:
-
-                # Don't list sensors twice.
-                if any(map(lambda item: item.sensor_id == observation.meta.sensor_id, station["sensors"])):
-                    continue
+    def get_stations(self):
+        return self.derive_stations(self.get_readings())
 
-                # Build and record sensor information.
-                sensor_info = Munch(
-                    {
-                        "sensor_id": observation.meta.sensor_id,
-                        "sensor_type_name": observation.meta.sensor_type_name,
-                        "sensor_type_id": observation.meta.sensor_type_id,
-                    }
-                )
-                station["sensors"].append(sensor_info)
+    @staticmethod
+    def sensor_keys(observation):
+        return [observation.meta.sensor_id]
 
-        # List of stations sorted by station identifier.
-        results = sorted(stations.values(), key=itemgetter("station_id"))
-        return results
+    @staticmethod
+    def make_sensor(observation, key):
+        return Munch(
+            {
+                "sensor_id": observation.meta.sensor_id,
+                "sensor_type_name": observation.meta.sensor_type_name,
+                "sensor_type_id": observation.meta.sensor_type_id,
+            }
+        )
 
     def get_readings_from_api(self):
 
         # Fetch data from remote API.
+        # Decode items of the top-level JSON array one by one, while streaming the response.
         log.info("Requesting luftdaten.info live API at {}".format(self.uri))
-        payload = self.session.get(self.uri).content.decode("utf-8")
-        data = json.loads(payload)
-        # pprint(data)
+        try:
+            response = self.http_get(self.uri, conditional=True, stream=True)
+        except NotModified:
+            return
+        response.raise_for_status()
+        data = read_json_array(response.iter_content(chunk_size=self.chunk_size))
+
+        first = next(data, None)
+        if first is None:
+            log.warning("No records found")
+            return
+        data = chain([first], data)
 
         # Mungle timestamp to be formally in ISO 8601 format (UTC).
-        timestamp = self.convert_timestamp(data[0]["timestamp"])
+        timestamp = self.convert_timestamp(first["timestamp"])
         log.info("Timestamp of first record: {}".format(timestamp))
 
         # Apply data filter.
         data = self.apply_filter(data)
 
+        # Optionally, skip items already processed by previous invocations.
+        if self.incremental:
+            data = self.skip_processed(data)
+
         # Transform live API items to actual readings while optionally
         # applying a number of transformation and enrichment steps.
         for item in self.wrap_progress(data):
@@ -111,6 +117,38 @@ class LuftdatenPumpe(AbstractLuftdatenPumpe):
             except Exception:
                 log.exception(f"Could not make reading from item: {item}")
 
+    def skip_processed(self, data):
+        """
+        Skip items not newer than the high-watermark timestamp of their sensor,
+        as recorded by previous invocations. Record new high-watermarks, to be
+        persisted after the data has been flushed to the data sinks.
+        """
+
+        namespace = self.domain_namespace("watermarks")
+        watermarks = self.load_state(namespace)
+        log.info(f"Loaded high-watermarks for {len(watermarks)} sensors")
+
+        # Items are compared against the high-watermarks of previous invocations only,
+        # because the items of a single snapshot are not ordered by timestamp.
+        newest = {}
+        skipped = 0
+        for item in data:
+            sensor_id = str(item["sensor"]["id"])
+            timestamp = item["timestamp"]
+
+            # LDI timestamps like "2019-04-25 04:36:26" are lexicographically sortable.
+            if sensor_id in watermarks and timestamp <= watermarks[sensor_id]:
+                skipped += 1
+                continue
+
+            if sensor_id not in newest or timestamp > newest[sensor_id]:
+                newest[sensor_id] = timestamp
+                self.stage_state(namespace, sensor_id, timestamp)
+
+            yield item
+
+        log.info(f"Skipped {skipped} items already processed by previous invocations")
+
     def make_observations_from_api(self, item, reading):
 
         # Collect sensor values.
@@ -240,35 +278,121 @@ class LuftdatenPumpe(AbstractLuftdatenPumpe):
 
     def get_readings_from_csv(self, path):
 
-        # Optionally append suffix appropriately.
-        suffix = ".csv"
-        if not path.endswith(suffix):
-            path += "/**/*" + suffix
-
+        # Find CSV files, optionally compressed or bundled into ZIP files.
         log.info("Building list of CSV files from {}".format(path))
-        data = list(find_files(path))
+        data = find_archive_files(path)
+
+        # Optionally, skip files already processed by previous invocations.
+        if self.incremental:
+            data = self.skip_ingested(data)
+
         log.info("Processing {} files".format(len(data)))
 
-        # Process all files, optionally add progressbar indicator.
-        for csvpath in self.wrap_progress(data):
-            readings = self.import_csv(csvpath)
+        # Process all files, optionally using a pool of worker processes.
+        if self.workers:
+            results = self.import_csv_pool(data)
+        else:
+            results = ((csvpath, self.import_csv_file(csvpath)) for csvpath in self.wrap_progress(data))
+
+        for csvpath, readings in results:
+            # Files without any readings, e.g. of unsupported sensor types, are
+            # recorded as well. Only files which failed to decode are not.
             if readings is None:
                 continue
+            if self.incremental:
+                self.record_ingested(csvpath)
+            yield from readings
+
+    def skip_ingested(self, csvpaths):
+        """
+        Skip archive files ingested by previous invocations, as recorded by their
+        size, modification time and content hash. The content hash is only
+        computed for files which are new, or where size or modification time
+        changed. Record all other files, to be persisted after the data has been
+        flushed to the data sinks. New and changed files are only recorded after
+        they have been decoded successfully, see ``record_ingested``.
+        """
+
+        namespace = self.domain_namespace("manifest")
+        manifest = self.load_state(namespace)
+        log.info(f"Loaded manifest of {len(manifest)} files")
+
+        self.pending_files = {}
+        selected = []
+        for csvpath in csvpaths:
+
+            # Files not matching the filter pattern will not be ingested.
+            if not self.import_archive_filename_accepted(csvpath):
+                continue
 
-            # Optionally, return first reading only.
-            # This is a shortcut-option for churning through the whole data set quickly.
-            # This can be used to get whole regional coverage of the data while lacking many details.
-            if self.quick_mode:
-                readings = list(readings)
-                if readings:
-                    yield readings[0]
-                    continue
+            key = os.path.abspath(csvpath)
+            entry = archive_file_stat(csvpath)
 
-            # Process all readings per CSV file.
-            for reading in readings:
-                if reading is None:
-                    continue
-                yield reading
+            previous = manifest.get(key)
+            if previous and previous["size"] == entry["size"] and previous["mtime"] == entry["mtime"]:
+                continue
+
+            entry["hash"] = archive_file_digest(csvpath)
+            if previous and previous["hash"] == entry["hash"]:
+                self.stage_state(namespace, key, entry)
+                continue
+
+            self.pending_files[csvpath] = (key, entry)
+            selected.append(csvpath)
+
+        log.info(f"Skipping {len(csvpaths) - len(selected)} files already ingested by previous invocations")
+        return selected
+
+    def record_ingested(self, csvpath):
+        """
+        Record an archive file which has been decoded successfully, to be
+        persisted after the data has been flushed to the data sinks.
+        """
+        if csvpath in self.pending_files:
+            key, entry = self.pending_files.pop(csvpath)
+            self.stage_state(self.domain_namespace("manifest"), key, entry)
+
+    def import_csv_file(self, csvpath):
+        """
+        Decode all readings from a single CSV file into a list.
+        Returns an empty list for files of unsupported sensor types,
+        and ``None`` when the file could not be decoded.
+        """
+        readings = self.import_csv(csvpath)
+        if readings is None:
+            return []
+
+        # Optionally, return first reading only.
+        # This is a shortcut-option for churning through the whole data set quickly.
+        # This can be used to get whole regional coverage of the data while lacking many details.
+        if self.quick_mode:
+            readings = islice(readings, 1)
+
+        try:
+            return list(filter(None, readings))
+        except Exception:
+            log.exception(f"Could not import CSV file {csvpath}")
+            return None
+
+    def import_csv_pool(self, csvpaths):
+        """
+        Decode CSV files in a pool of worker processes, yielding the path and
+        the readings of each file as a list. Enrichment, e.g. reverse geocoding,
+        is carried out on the main process.
+        """
+        log.info(f"Decoding CSV files using {self.workers} worker processes")
+        settings = {"filter": self.filter, "progressbar": self.progressbar, "quick_mode": self.quick_mode}
+        with Pool(self.workers, initializer=init_csv_worker, initargs=(self.__class__, settings)) as pool:
+            if self.unordered:
+                results = pool.imap_unordered(import_csv_worker, csvpaths, chunksize=self.worker_chunksize)
+            else:
+                results = pool.imap(import_csv_worker, csvpaths, chunksize=self.worker_chunksize)
+            if self.progressbar:
+                results = tqdm(results, total=len(csvpaths))
+            for csvpath, readings in results:
+                for reading in readings or []:
+                    self.enrich_station(reading.station)
+                yield csvpath, readings
 
     @staticmethod
     def sensor_matches(path, sensors):
@@ -360,114 +484,105 @@ class LuftdatenPumpe(AbstractLuftdatenPumpe):
         return self.csv_reader(csvpath, fieldnames)
 
     def csv_reader(self, csvpath, fieldnames):
+        csvfile = open_archive_file(csvpath)
+        with csvfile:
+            yield from self.decode_csv(csvfile, fieldnames, origin=csvpath)
 
-        payload = None
-        if self.quick_mode:
-            try:
-                payload = open(csvpath).read(256)
-                payload = "\n".join(payload.split("\n")[:2])
-            except:  # noqa:E722
-                pass
-        else:
-            payload = open(csvpath).read()
-
-        if payload is None:
-            log.error(f'Could not read CSV file "{csvpath}')
-            return
-
-        # Read CSV file into tablib's Dataset and cast to dictionary representation.
-        try:
-            imported_data = Dataset().load(payload, format="csv", delimiter=";")
-        except:  # noqa:E722
-            log.exception(f"Error decoding CSV from file {csvpath}")
-            return
-
-        records = imported_data.dict
+    def decode_csv(self, stream, fieldnames, origin=None):
+        """
+        Decode readings from a stream of semicolon-delimited CSV records
+        of the archive, row by row.
 
-        # Iterate all CSV records.
-        for record in records:
+        Readings are built directly from the columns, using the header row
+        to locate the metadata columns and the value columns of the sensor
+        family given by ``fieldnames``.
 
-            try:
-                # Make item from CSV record.
-                item = self.read_csv_record(record)
+        Errors decoding individual records are logged and skipped, while errors
+        reading the file itself are raised.
 
-                # Make reading from item.
-                reading = self.make_reading(item)
-                if reading is None:
-                    continue
+        ::
 
-                if not self.make_observations(record, reading, fieldnames):
-                    continue
-
-                log.debug(f"CSV reading:\n{json.dumps(reading, indent=2)}")
-
-                yield reading
-
-            except Exception:
-                log.exception(f"Could not make observation from CSV record {record}")
-
-    def make_observations(self, record, reading, fieldnames):
-
-        # Indicator whether we found any data.
-        has_data = False
+            sensor_id;sensor_type;location;lat;lon;timestamp;P1;durP1;ratioP1;P2;durP2;ratioP2
+            92;SDS011;42;48.800;9.003;2016-07-14T13:02:46.949036+00:00;7.71;;;5.03;;
+        """
+        reader = csv.reader(stream, delimiter=";")
 
-        # Read all the CSV record fields.
-        for fieldname in fieldnames:
+        header = next(reader, None)
+        if header is None:
+            return
+        columns = {name: index for index, name in enumerate(header)}
+        missing = {"sensor_id", "sensor_type", "location", "lat", "lon", "timestamp"} - set(columns)
+        if missing:
+            raise ValueError(f"CSV file {origin} lacks columns {sorted(missing)}")
+        sensor_id_column, sensor_type_column, location_column, lat_column, lon_column, timestamp_column = (
+            columns[name] for name in ["sensor_id", "sensor_type", "location", "lat", "lon", "timestamp"]
+        )
 
-            # Skip missing keys.
-            if fieldname not in record:
-                continue
+        # Only decode value columns of the sensor family which are present in this file.
+        value_columns = [(fieldname, columns[fieldname]) for fieldname in fieldnames if fieldname in columns]
 
-            # Sanitize value.
-            value = record[fieldname].strip()
+        # In quick mode, only decode the first record.
+        if self.quick_mode:
+            reader = islice(reader, 1)
 
-            # Skip empty or non-numeric values.
-            # TODO: Emit warning here?
-            if is_nan(value):
-                continue
+        for row in reader:
 
-            # Skip non-float values.
-            # TODO: Emit warning here?
             try:
-                value = float(value)
-            except:  # noqa:E722
-                continue
-
-            # Actually use this reading. LDI has single observations only.
-            reading.observations[0]["data"][fieldname] = value
-
-            # Signal positive dataness.
-            has_data = True
-
-        return has_data
+                # Collect sensor values, skipping empty, NaN or non-float values.
+                data = Munch()
+                for fieldname, index in value_columns:
+                    try:
+                        value = float(row[index])
+                    except ValueError:
+                        continue
+                    if math.isnan(value):
+                        continue
+                    data[fieldname] = value
+
+                # Skip records without any data.
+                if not data:
+                    continue
 
-    def read_csv_record(self, csvitem):
+                # Build reading. LDI has single observations only.
+                position = Munch()
+                if row[lat_column] and row[lon_column]:
+                    position.latitude = float(row[lat_column])
+                    position.longitude = float(row[lon_column])
+
+                reading = Munch(
+                    station=Munch(station_id=int(row[location_column]), position=position),
+                    observations=[
+                        Munch(
+                            meta=Munch(
+                                timestamp=self.convert_timestamp(row[timestamp_column]),
+                                sensor_id=int(row[sensor_id_column]),
+                                sensor_type_name=row[sensor_type_column],
+                                sensor_type_id=None,
+                            ),
+                            data=data,
+                        )
+                    ],
+                )
 
-        # log.debug('CSV item: %s', csvitem)
+                # Add more detailed location information.
+                self.enrich_station(reading.station)
 
-        item = {
-            "timestamp": csvitem["timestamp"],
-            "location": {
-                "id": int(csvitem["location"]),
-            },
-            "sensor": {
-                "id": int(csvitem["sensor_id"]),
-                "sensor_type": {
-                    "name": csvitem["sensor_type"],
-                },
-            },
-        }
+                if log.isEnabledFor(logging.DEBUG):
+                    log.debug(f"CSV reading:\n{json.dumps(reading, indent=2)}")
 
-        if csvitem["lat"] and csvitem["lon"]:
-            item["location"].update(latitude=float(csvitem["lat"]), longitude=float(csvitem["lon"]))
+                yield reading
 
-        return item
+            except Exception:
+                log.exception(f"Could not make observation from CSV record {row}")
 
     def import_archive_filename_accepted(self, csvpath):
         # If there is a filter defined, evaluate it.
         # For specific location|sensor ids, skip further processing.
         if self.filter:
 
+            # Evaluate the name of the CSV file, also when it is compressed.
+            csvpath = strip_compression_suffix(csvpath)
+
             if "sensor" in self.filter:
                 # Decode station id from filename, e.g. ``2017-01-13_dht22_sensor_318.csv``.
                 m = re.match(r".+sensor_(\d+)\.csv$", csvpath)
@@ -485,3 +600,20 @@ class LuftdatenPumpe(AbstractLuftdatenPumpe):
                         return False
 
         return True
+
+
+# Data source instance of each CSV worker process.
+csv_worker_pump = None
+
+
+def init_csv_worker(pump_class, settings):
+    global csv_worker_pump
+    csv_worker_pump = pump_class(**settings)
+
+    # Do not share file positions of ZIP files opened before forking with the parent process.
+    open_zip_bundle.cache_clear()
+    csv_worker_pump.enrichment_deferred = True
+
+
+def import_csv_worker(csvpath):
+    return csvpath, csv_worker_pump.import_csv_file(csvpath)
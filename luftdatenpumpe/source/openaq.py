@@ -5,18 +5,53 @@
 # License: GNU Affero General Public License, Version 3
 import json
 import logging
+import math
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from operator import itemgetter
+from itertools import chain, islice
 
 import openaq
 from munch import Munch
+from openaq.exceptions import ApiError
 from rfc3339 import rfc3339
 
-from luftdatenpumpe.source.common import AbstractLuftdatenPumpe
+from luftdatenpumpe.source.common import AbstractLuftdatenPumpe, NotModified
 
 log = logging.getLogger(__name__)
 
 
+class OpenAQClient(openaq.OpenAQ):
+    """
+    Route requests of the OpenAQ API wrapper through the HTTP session
+    of the data source, optionally issuing conditional requests.
+    """
+
+    def __init__(self, pump, conditional=False, **kwargs):
+        super().__init__(**kwargs)
+        self._baseurl = pump.uri
+        self.pump = pump
+        self.conditional = conditional
+
+    def _send(self, endpoint, method="GET", **kwargs):
+        if method != "GET":
+            raise ApiError("Invalid Method")
+
+        url = self._make_url(endpoint, **kwargs)
+        response = self.pump.http_get(url, conditional=self.conditional, headers=self._headers)
+        if response.status_code != 200:
+            raise ApiError(f"A bad request was made: {response.status_code}")
+
+        result = response.json()
+
+        # Add a "pages" attribute to the metadata.
+        meta = result.get("meta") or {}
+        if meta.get("found") is not None and meta.get("limit"):
+            meta["pages"] = math.ceil(meta["found"] / meta["limit"])
+
+        return response.status_code, result
+
+
 class OpenAQPumpe(AbstractLuftdatenPumpe):
     """
     Ingest air quality measurements from the OpenAQ platform.
@@ -29,56 +64,21 @@ class OpenAQPumpe(AbstractLuftdatenPumpe):
 
     # Sensor network identifier.
     network = "openaq"
-    uri = "data.openaq.org"
+    uri = "https://api.openaq.org"
+
+    # Number of results per page.
+    page_size = 10000
 
     def get_stations(self):
+        return self.derive_stations(self.get_readings())
 
-        stations = {}
-        field_candidates = ["station_id", "name", "position", "location"]
-        for reading in self.get_readings():
-
-            # Location ID is "station_id" here.
-            station_id = reading.station.station_id
-
-            # New station found: Acquire its information from the reading itself.
-            if station_id not in stations:
-                station = Munch()
-                for field in field_candidates:
-                    if field in reading.station:
-                        station[field] = reading.station[field]
-                station.sensors = []
-
-                # Record station.
-                stations[station_id] = station
-
-            # Use recorded station.
-            station = stations[station_id]
-
-            # Deduce sensor information from the reading itself.
-            keys = set()
-            for observation in reading.observations:
-
-                for key in observation.data.keys():
-                    keys.add(key)
-
-            for key in keys:
-                # Don't list sensors twice.
-                # if any(map(lambda item: item.sensor_id == observation.meta.sensor_id, station['sensors'])):
-                #    continue
-
-                # Build and record sensor information.
-                sensor_info = Munch(
-                    {
-                        # 'sensor_id': observation.meta.sensor_id,
-                        "sensor_type_name": key,
-                        # 'sensor_type_id': observation.meta.sensor_type_id,
-                    }
-                )
-                station["sensors"].append(sensor_info)
+    @staticmethod
+    def sensor_keys(observation):
+        return observation.data.keys()
 
-        # List of stations sorted by station identifier.
-        results = sorted(stations.values(), key=itemgetter("station_id"))
-        return results
+    @staticmethod
+    def make_sensor(observation, key):
+        return Munch({"sensor_type_name": key})
 
     def get_readings_from_api(self):
         # return self.get_latest_readings()
@@ -101,19 +101,16 @@ class OpenAQPumpe(AbstractLuftdatenPumpe):
         # Fetch data from remote API.
         log.info("Requesting measurement data from OpenAQ")
 
-        api = openaq.OpenAQ()
-
         params = {}
         if self.filter and "country" in self.filter:
             params["country"] = self.filter["country"]
 
         # TODO: What to do with readings which do not have any geographic information?
-        # TODO: Raise limit by introducing result paging.
         date_from = self.last_hour()
-        status, response = api.measurements(
-            date_from=date_from, has_geo=True, limit=10000, include_fields=["attribution"], **params
+        pages = self.get_pages(
+            "measurements", date_from=date_from, has_geo=True, include_fields=["attribution"], **params
         )
-        data = response["results"]
+        data = next(pages)
 
         if not data:
             log.warning("No records found beginning {} with filter {}".format(date_from, params))
@@ -128,22 +125,19 @@ class OpenAQPumpe(AbstractLuftdatenPumpe):
 
         # Transform live API items to actual readings while optionally
         # applying a number of transformation and enrichment steps.
-        readings = {}
-        for item in self.wrap_progress(data):
-            try:
-                self.process_measurement(readings, item)
-
-            except:  # noqa:E722
-                log.exception(f"Could not use observation from item: {item}")
-
-        for reading in readings.values():
-            has_data = False
-            for observation in reading.observations:
-                if observation["data"]:
-                    has_data = True
-                    break
-            if has_data:
-                yield reading
+        # Measurements are grouped into readings per page, so memory usage is bounded by the page size.
+        for page in chain([data], pages):
+            readings = {}
+            for item in self.wrap_progress(page):
+                try:
+                    self.process_measurement(readings, item)
+
+                except:  # noqa:E722
+                    log.exception(f"Could not use observation from item: {item}")
+
+            for reading in readings.values():
+                if any(observation["data"] for observation in reading.observations):
+                    yield reading
 
     def process_measurement(self, readings, item):
         """
@@ -246,9 +240,6 @@ class OpenAQPumpe(AbstractLuftdatenPumpe):
         # Fetch data from remote API.
         log.info("Requesting latest data from OpenAQ")
 
-        # TODO: Use `openaq.OpenAQ(version="v2")`.
-        api = openaq.OpenAQ()
-
         # Example.
         # res = api.latest(city='Delhi', parameter='pm25', df=True)
         # print(res.columns)
@@ -258,11 +249,21 @@ class OpenAQPumpe(AbstractLuftdatenPumpe):
             params["country"] = self.filter["country"]
 
         # TODO: What to do with readings which do not have any geographic information?
-        # TODO: Raise limit by introducing result paging.
-        status, response = api.latest(
-            has_geo=True, limit=10000, include_fields=["attribution", "averagingPeriod", "sourceName"], **params
+        pages = self.get_pages(
+            "latest",
+            conditional=True,
+            has_geo=True,
+            include_fields=["attribution", "averagingPeriod", "sourceName"],
+            **params,
         )
-        data = response["results"]
+        try:
+            data = next(pages)
+        except NotModified:
+            return
+
+        if not data:
+            log.warning(f"No records found with filter {params}")
+            return
 
         # Mungle timestamp to be formally in ISO 8601 format (UTC).
         timestamp = data[0]["measurements"][0]["lastUpdated"]
@@ -273,18 +274,49 @@ class OpenAQPumpe(AbstractLuftdatenPumpe):
 
         # Transform live API items to actual readings while optionally
         # applying a number of transformation and enrichment steps.
-        for item in self.wrap_progress(data):
-            try:
-                reading = self.make_reading_from_latest(item)
-                if reading is None:
-                    continue
+        for page in chain([data], pages):
+            for item in self.wrap_progress(page):
+                try:
+                    reading = self.make_reading_from_latest(item)
+                    if reading is None:
+                        continue
+
+                    log.debug(f"API reading:\n{json.dumps(reading, indent=2)}")
 
-                log.debug(f"API reading:\n{json.dumps(reading, indent=2)}")
+                    yield reading
 
-                yield reading
+                except:  # noqa:E722
+                    log.exception(f"Could not make reading from item: {item}")
+
+    def get_pages(self, endpoint, conditional=False, **params):
+        """
+        Acquire all result pages from given API endpoint, yielding their results in order.
 
-            except:  # noqa:E722
-                log.exception(f"Could not make reading from item: {item}")
+        The first page is requested on its own, optionally using a conditional request,
+        in order to learn about the total number of pages. The others are requested
+        concurrently, keeping at most ``concurrency`` pages in flight.
+        """
+
+        # TODO: Use `openaq.OpenAQ(version="v2")`.
+        api = OpenAQClient(self, conditional=conditional)
+        _, response = getattr(api, endpoint)(page=1, limit=self.page_size, **params)
+        pages = response["meta"].get("pages", 1)
+        log.info(f'Acquired page 1 of {pages} from OpenAQ "{endpoint}" API')
+        yield response["results"]
+
+        api = OpenAQClient(self)
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+
+            def submit(page):
+                return executor.submit(getattr(api, endpoint), page=page, limit=self.page_size, **params)
+
+            page_numbers = iter(range(2, pages + 1))
+            futures = deque(submit(page) for page in islice(page_numbers, self.concurrency))
+            while futures:
+                _, response = futures.popleft().result()
+                for page in islice(page_numbers, 1):
+                    futures.append(submit(page))
+                yield response["results"]
 
     def make_reading_from_latest(self, item):
         """
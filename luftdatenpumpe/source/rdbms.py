@@ -2,8 +2,11 @@
 # (c) 2017-2019 Andreas Motl <andreas@hiveeyes.org>
 # (c) 2017-2019 Richard Pobering <richard@hiveeyes.org>
 # License: GNU Affero General Public License, Version 3
+import json
+
 from munch import munchify
 
+from luftdatenpumpe.geo import osm_address_fields
 from luftdatenpumpe.target.rdbms import RDBMSStorage
 from luftdatenpumpe.util import sanitize_dbsymbol
 
@@ -102,3 +105,38 @@ def fetch_from_rdbms(dsuri, prefix):
     storage = RDBMSStorage(dsuri)
     for station in storage.db.query(sql):
         yield munchify(station)
+
+
+def locations_from_rdbms(dsuri, network):
+    """
+    Re-make locations of stations from the "osmdata" table of the PostgreSQL database,
+    as triples of ``(latitude, longitude, location)``, for reusing them as known locations.
+    """
+    storage = RDBMSStorage(dsuri, network=network)
+    realm = storage.realm
+
+    sql = f"""
+        SELECT {realm}_stations.latitude, {realm}_stations.longitude, {realm}_osmdata.*
+        FROM {realm}_stations
+        JOIN {realm}_osmdata ON {realm}_stations.station_id = {realm}_osmdata.station_id
+    """
+    for record in storage.db.query(sql):
+        if record["latitude"] is None or record["longitude"] is None:
+            continue
+
+        # Revert the column name prefix and the flattened address.
+        location = {"address": {}}
+        for key, value in record.items():
+            if not key.startswith("osm_") or value is None:
+                continue
+            name = key[4:]
+            if key in ["osm_type", "osm_id"]:
+                location[key] = value
+            elif name == "address_more":
+                location["address"].update(json.loads(value))
+            elif name in osm_address_fields:
+                location["address"][name] = value
+            else:
+                location[name] = value
+
+        yield record["latitude"], record["longitude"], location
@@ -0,0 +1,89 @@
+# (c) 2026 Andreas Motl <andreas.motl@panodata.org>
+# License: GNU Affero General Public License, Version 3
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+import appdirs
+
+from luftdatenpumpe import __appname__ as APP_NAME
+
+log = logging.getLogger(__name__)
+
+
+class StateStore:
+    """
+    Persist state between invocations, using an SQLite database.
+
+    State is organized into namespaces, each holding a mapping of
+    keys to JSON-serializable values. The database file is only
+    created when state is actually accessed.
+    """
+
+    filename = "state.sqlite"
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.RLock()
+        self._connection = None
+
+    @classmethod
+    def from_directory(cls, directory=None):
+        directory = directory or appdirs.user_state_dir(APP_NAME)
+        return cls(os.path.join(directory, cls.filename))
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} {self.path}>"
+
+    @property
+    def connection(self):
+        with self.lock:
+            if self._connection is None:
+                log.info(f"Using state database at {self.path}")
+                directory = os.path.dirname(self.path)
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+                self._connection = sqlite3.connect(self.path, check_same_thread=False)
+                self._connection.execute("PRAGMA journal_mode=WAL")
+                self.ensure_schema()
+            return self._connection
+
+    def ensure_schema(self):
+        self._connection.execute("""
+            CREATE TABLE IF NOT EXISTS state (
+                namespace TEXT NOT NULL,
+                key TEXT NOT NULL,
+                value TEXT,
+                updated REAL,
+                PRIMARY KEY (namespace, key)
+            )
+            """)
+
+    def load(self, namespace):
+        with self.lock:
+            cursor = self.connection.execute("SELECT key, value FROM state WHERE namespace=?", (namespace,))
+            return {key: json.loads(value) for key, value in cursor}
+
+    def get(self, namespace, key, default=None):
+        with self.lock:
+            cursor = self.connection.execute(
+                "SELECT value FROM state WHERE namespace=? AND key=?", (namespace, str(key))
+            )
+            row = cursor.fetchone()
+        if row is None:
+            return default
+        return json.loads(row[0])
+
+    def update(self, namespace, mapping):
+        now = time.time()
+        records = [(namespace, str(key), json.dumps(value), now) for key, value in mapping.items()]
+        sql = "REPLACE INTO state (namespace, key, value, updated) VALUES (?, ?, ?, ?)"
+        with self.lock, self.connection:
+            self.connection.executemany(sql, records)
+
+    def purge(self, namespace):
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM state WHERE namespace=?", (namespace,))
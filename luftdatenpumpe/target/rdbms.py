@@ -220,7 +220,8 @@ class RDBMSStorage:
                 del location["address_more"]
 
             # TODO: Also store bounding box
-            del location["boundingbox"]
+            # Locations re-made from the database by ``locations_from_rdbms`` lack it.
+            location.pop("boundingbox", None)
 
             osmdata.update(location)
 
@@ -0,0 +1,87 @@
+# (c) 2026 Andreas Motl <andreas.motl@panodata.org>
+# License: GNU Affero General Public License, Version 3
+import logging
+from queue import Queue
+from threading import Thread
+
+log = logging.getLogger(__name__)
+
+
+class ThreadedTarget:
+    """
+    Run a data sink on its own worker thread, behind a bounded queue.
+
+    The main thread only enqueues items, so a slow data sink will not hold
+    up the others. When the queue is full, ``emit`` will block, in order to
+    keep memory consumption bounded.
+
+    Exceptions raised by the wrapped data sink are re-raised on the main
+    thread on the next call to ``emit`` or ``flush``.
+
+    ``close`` shuts down the worker thread after the queue has been drained.
+    It will be started again on the next call to ``emit`` or ``flush``, so
+    the data sink can be reused across multiple invocations.
+    """
+
+    EMIT = "emit"
+    FLUSH = "flush"
+    CLOSE = "close"
+
+    def __init__(self, target, queue_size=1000):
+        self.target = target
+        self.capabilities = target.capabilities
+        self.queue = Queue(maxsize=queue_size)
+        self.error = None
+        self.thread = None
+        self.start()
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} {self.target}>"
+
+    def start(self):
+        if self.thread is None or not self.thread.is_alive():
+            self.thread = Thread(target=self.worker, name=f"target-{self.target.__class__.__name__}")
+            self.thread.start()
+
+    def emit(self, item):
+        self.raise_error()
+        self.start()
+        self.queue.put((self.EMIT, item))
+
+    def flush(self, final=False):
+        self.raise_error()
+        self.start()
+        self.queue.put((self.FLUSH, final))
+
+        # Wait for the queue to drain.
+        if final:
+            self.queue.join()
+            self.raise_error()
+
+    def close(self):
+        if self.thread is not None and self.thread.is_alive():
+            self.queue.put((self.CLOSE, None))
+            self.thread.join()
+        self.raise_error()
+
+    def raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def worker(self):
+        while True:
+            command, payload = self.queue.get()
+            try:
+                if command == self.EMIT:
+                    self.target.emit(payload)
+                elif command == self.FLUSH:
+                    self.target.flush(final=payload)
+                elif command == self.CLOSE:
+                    break
+            except Exception as ex:
+                log.exception(f"Data sink {self.target} failed")
+                if self.error is None:
+                    self.error = ex
+            finally:
+                self.queue.task_done()
@@ -2,19 +2,34 @@
 # (c) 2017,2018 Andreas Motl <andreas@hiveeyes.org>
 # (c) 2017,2018 Richard Pobering <richard@hiveeyes.org>
 # License: GNU Affero General Public License, Version 3
+import codecs
 import glob
+import gzip
+import hashlib
+import io
 import json
 import logging
 import os
 import re
 import sys
+import time
 import unicodedata
+import zipfile
 from collections import OrderedDict
+from functools import lru_cache
 from itertools import zip_longest
 
 from docopt import docopt
 from munch import Munch, munchify
 
+try:
+    from compression import zstd
+except ImportError:
+    try:
+        import zstandard as zstd
+    except ImportError:
+        zstd = None
+
 log = logging.getLogger(__name__)
 
 
@@ -183,6 +198,128 @@ def find_files_walk(path, suffix):
 find_files = find_files_glob
 
 
+# Suffixes of CSV archive files, optionally compressed.
+CSV_SUFFIXES = (".csv", ".csv.gz", ".csv.zst")
+COMPRESSION_SUFFIXES = (".gz", ".zst")
+
+
+def find_archive_files(path):
+    """
+    Find CSV archive files, optionally compressed, including CSV files within
+    ZIP bundles. Those are addressed like ``2017-11.zip/2017-11-26_dht22_sensor_318.csv``.
+    """
+    if path.endswith(CSV_SUFFIXES + (".zip",)):
+        patterns = [path]
+    else:
+        patterns = [path + "/**/*" + suffix for suffix in CSV_SUFFIXES + (".zip",)]
+
+    files = []
+    for pattern in patterns:
+        for filename in find_files(pattern):
+            if filename.endswith(".zip"):
+                try:
+                    members = zip_members(filename)
+                except Exception:
+                    log.exception(f"Could not read ZIP file {filename}")
+                    continue
+                files += [f"{filename}/{name}" for name in members if name.endswith(".csv")]
+            else:
+                files.append(filename)
+
+    return sorted(files)
+
+
+def split_archive_path(path):
+    """
+    Split path into path of ZIP bundle and name of its member.
+    """
+    container, separator, member = path.partition(".zip/")
+    if not separator:
+        return None, None
+    return container + ".zip", member
+
+
+def zip_members(path):
+    """
+    Return the members of a ZIP file by name. Results are cached by path,
+    modification time and size, so they are read again when the file is replaced.
+    """
+    stat = os.stat(path)
+    return read_zip_members(path, stat.st_mtime_ns, stat.st_size)
+
+
+@lru_cache(maxsize=16)
+def read_zip_members(path, mtime, size):
+    return {info.filename: info for info in open_zip_bundle(path, mtime, size).infolist()}
+
+
+@lru_cache(maxsize=4)
+def open_zip_bundle(path, mtime, size):
+    """
+    Open a ZIP file, keeping it open for reading its members one after another,
+    so its central directory is only read once.
+    """
+    return zipfile.ZipFile(path)
+
+
+def strip_compression_suffix(path):
+    for suffix in COMPRESSION_SUFFIXES:
+        if path.endswith(suffix):
+            return path[: -len(suffix)]
+    return path
+
+
+def open_archive_file(path):
+    """
+    Open CSV archive file for reading, transparently decompressing it while streaming.
+    """
+    container, member = split_archive_path(path)
+    if container:
+        stat = os.stat(container)
+        bundle = open_zip_bundle(container, stat.st_mtime_ns, stat.st_size)
+        return io.TextIOWrapper(bundle.open(member), newline="")
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt", newline="")
+    if path.endswith(".zst"):
+        if zstd is None:
+            raise ImportError('Reading Zstandard-compressed files requires the "zstandard" package')
+        return zstd.open(path, "rt", newline="")
+    return open(path, newline="")
+
+
+def archive_file_stat(path):
+    """
+    Return size and modification time of CSV archive file.
+    """
+    container, member = split_archive_path(path)
+    if container:
+        info = zip_members(container)[member]
+        return {"size": info.file_size, "mtime": time.mktime(info.date_time + (0, 0, -1))}
+    stat = os.stat(path)
+    return {"size": stat.st_size, "mtime": stat.st_mtime}
+
+
+def archive_file_digest(path):
+    """
+    Compute digest of CSV archive file content. For files within ZIP bundles, use their CRC.
+    """
+    container, member = split_archive_path(path)
+    if container:
+        return f"crc32:{zip_members(container)[member].CRC:08x}"
+    return file_digest(path)
+
+
+def file_digest(path, chunk_size=1024 * 1024):
+    """
+    Compute digest of file content.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
 def sanitize_dbsymbol(symbol):
     return symbol.replace("-", "_")
 
@@ -253,6 +390,72 @@ def chunks(iterable, chunksize):
         yield remove_all(list(group), None)
 
 
+def read_json_array(chunks):
+    """
+    Incrementally decode the items of a top-level JSON array from
+    a stream of UTF-8 encoded byte chunks, yielding them one by one.
+
+    This avoids keeping the whole payload, its decoded string, and the
+    whole object tree in memory at once. Use it like::
+
+        response = requests.get(url, stream=True)
+        for item in read_json_array(response.iter_content(chunk_size=65536)):
+            print(item)
+
+    """
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder("utf-8")()
+    whitespace = re.compile(r"[ \t\n\r]*")
+
+    buffer = ""
+    started = False
+    finished = False
+    chunks = iter(chunks)
+    while not finished:
+        chunk = next(chunks, None)
+        final = chunk is None
+        buffer += text_decoder.decode(chunk or b"", final=final)
+
+        position = 0
+        while True:
+            position = whitespace.match(buffer, position).end()
+            if position >= len(buffer):
+                break
+
+            char = buffer[position]
+            if not started:
+                if char != "[":
+                    raise ValueError(f"Expected JSON array, got {buffer[position:position + 20]!r}")
+                started = True
+                position += 1
+                continue
+            if char == ",":
+                position += 1
+                continue
+            if char == "]":
+                return
+
+            # Decode next item. When it is incomplete, wait for more data.
+            try:
+                item, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                if final:
+                    raise
+                break
+
+            # Numbers might be truncated at the end of the buffer.
+            if end == len(buffer) and not final:
+                break
+
+            yield item
+            position = end
+
+        buffer = buffer[position:]
+        finished = final
+
+    raise ValueError("Unexpected end of JSON array")
+
+
 class OptionMunch(Munch):
     def __setattr__(self, k, v):
         super().__setattr__(k.replace("-", "_"), v)
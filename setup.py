@@ -15,7 +15,7 @@ requires = [
     "tqdm<5",
     # Acquisition
     "requests<3",
-    "tablib[pandas]<4",
+    "pandas<4",
     "py-openaq<2",
     # Caching
     "requests-cache<2",
@@ -40,6 +40,9 @@ requires = [
 ]
 
 extras = {
+    "zstd": [
+        "zstandard<1; python_version<'3.14'",
+    ],
     "test": [
         "pytest>=7,<10",
         "attrs",
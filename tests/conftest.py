@@ -0,0 +1,48 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+
+class FixtureRequestHandler(BaseHTTPRequestHandler):
+    """
+    Base class for request handlers of HTTP fixture servers.
+    """
+
+    def respond(self, payload, status=200, content_type="application/json", headers=None):
+        if content_type == "application/json":
+            payload = json.dumps(payload)
+        if isinstance(payload, str):
+            payload = payload.encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def http_server():
+    """
+    Start HTTP servers on the loopback interface, using the given request handler class.
+    Returns the base URL of the server. All servers are shut down after the test.
+    """
+    servers = []
+
+    def start(handler, path="/"):
+        server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return f"http://127.0.0.1:{server.server_port}{path}"
+
+    yield start
+
+    for server in servers:
+        server.shutdown()
+        server.server_close()
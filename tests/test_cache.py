@@ -0,0 +1,63 @@
+import time
+
+import pytest
+from dogpile.cache import make_region
+from dogpile.cache.api import NO_VALUE
+
+from luftdatenpumpe import cache
+from luftdatenpumpe.cache import SQLiteBackend, cached_keys, dogpile_backend, requests_cache_backend
+
+
+def test_sqlite_backend(tmp_path):
+    """
+    The SQLite backend stores, retrieves and deletes values.
+    """
+    backend = SQLiteBackend({"filename": str(tmp_path / "cache.sqlite")})
+    backend.set_serialized_multi({"foo": b"bar", "baz": b"qux"})
+    assert backend.get_serialized("foo") == b"bar"
+    assert backend.get_serialized_multi(["baz", "unknown"]) == [b"qux", NO_VALUE]
+    backend.delete("foo")
+    assert backend.get_serialized("foo") is NO_VALUE
+
+
+def test_sqlite_backend_expiry(tmp_path):
+    """
+    The SQLite backend does not return expired values, and purges them when opening the database.
+    """
+    filename = str(tmp_path / "cache.sqlite")
+    backend = SQLiteBackend({"filename": filename, "expiration_time": 0.1})
+    backend.set_serialized("foo", b"bar")
+    assert backend.get_serialized("foo") == b"bar"
+    time.sleep(0.15)
+    assert backend.get_serialized("foo") is NO_VALUE
+
+    backend = SQLiteBackend({"filename": filename})
+    assert backend.connection.execute("SELECT COUNT(*) FROM cache").fetchone() == (0,)
+
+
+@pytest.mark.parametrize("backend", ["sqlite", "dbm", "memory"])
+def test_dogpile_region(tmp_path, monkeypatch, backend):
+    """
+    Functions can be cached using all local cache backends, and their keys can be enumerated.
+    """
+    monkeypatch.setattr(cache, "cache_directory", lambda: str(tmp_path))
+    name, arguments = dogpile_backend(backend, "test", expiration_time=60)
+    region = make_region().configure(name, arguments=arguments)
+
+    calls = []
+
+    @region.cache_on_arguments()
+    def location(latitude, longitude):
+        calls.append((latitude, longitude))
+        return {"address": {"city": "Stuttgart"}}
+
+    assert location(48.7, 9.2) == location(48.7, 9.2) == {"address": {"city": "Stuttgart"}}
+    assert calls == [(48.7, 9.2)]
+    assert cached_keys(region, "tests.test_cache:location|") == ["tests.test_cache:location|48.7 9.2"]
+
+
+def test_unknown_backend():
+    with pytest.raises(ValueError):
+        dogpile_backend("foo", "test")
+    with pytest.raises(ValueError):
+        requests_cache_backend("foo", "test")
@@ -0,0 +1,48 @@
+import logging
+import threading
+import time
+
+from luftdatenpumpe.daemon import Job
+
+
+def test_job_skips_overrunning_ticks(caplog):
+    """
+    When a job run overruns its interval, missed ticks are skipped,
+    and runs of the same job will never overlap.
+    """
+    stopped = threading.Event()
+    invocations = []
+
+    def function():
+        invocations.append(time.monotonic())
+        time.sleep(0.25)
+        if len(invocations) == 2:
+            stopped.set()
+
+    job = Job("testdrive", function, interval=0.1)
+    with caplog.at_level(logging.WARNING):
+        job.run_forever(stopped)
+
+    assert len(invocations) == 2
+    assert invocations[1] - invocations[0] >= 0.25
+    assert 'Job "testdrive" took' in caplog.text
+    assert "skipping 2 tick(s)" in caplog.text
+
+
+def test_job_survives_failures(caplog):
+    """
+    Exceptions raised by a job are logged, and do not stop the schedule.
+    """
+    stopped = threading.Event()
+    invocations = []
+
+    def function():
+        invocations.append(True)
+        if len(invocations) == 2:
+            stopped.set()
+        raise ValueError("Something failed")
+
+    Job("testdrive", function, interval=0.01).run_forever(stopped)
+
+    assert len(invocations) == 2
+    assert 'Job "testdrive" failed' in caplog.text
@@ -0,0 +1,298 @@
+import json
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+from munch import Munch
+
+from luftdatenpumpe import cache
+from luftdatenpumpe.source.eea import EEAAirQualityPumpe
+from luftdatenpumpe.state import StateStore
+from tests.conftest import FixtureRequestHandler
+
+COLUMNS = [
+    "Countrycode",
+    "Namespace",
+    "AirQualityNetwork",
+    "AirQualityStation",
+    "AirQualityStationEoICode",
+    "AirQualityStationNatCode",
+    "SamplingPoint",
+    "SamplingProces",
+    "Sample",
+    "AirPollutantCode",
+    "Projection",
+    "Longitude",
+    "Latitude",
+    "Altitude",
+    "MeasurementType",
+    "AirQualityStationType",
+    "AirQualityStationArea",
+    "EquivalenceDemonstrated",
+    "MeasurementEquipment",
+    "InletHeight",
+    "BuildingDistance",
+    "KerbDistance",
+]
+
+
+def sampling_point(country, code, number, pollutant):
+    return [
+        country,
+        f"{country}.Government.AQ",
+        f"NET-{country}001A",
+        f"STA-{code}",
+        code,
+        "0942",
+        f"SPO-{code}-{number:04d}",
+        f"SPP-{code}-{number:04d}",
+        f"SAM-{code}-{number:04d}",
+        f"http://dd.eionet.europa.eu/vocabulary/aq/pollutant/{pollutant}",
+        "EPSG:4979",
+        "1.539138",
+        "42.509694",
+        "1080",
+        "automatic",
+        "background",
+        "urban",
+        "ref",
+        "",
+        "3",
+        "6",
+        "-999",
+    ]
+
+
+METADATA = [
+    sampling_point("DE", "DEBY001", 1, 5),
+    sampling_point("AD", "AD0942A", 1, 1),
+    sampling_point("DE", "DEBY001", 2, 7),
+    sampling_point("AD", "AD0942A", 2, 5),
+]
+
+
+MEASUREMENTS = {
+    ("AD", "8"): [
+        ["AD/SPO-AD0942A-0001", "NO2", "12.4", "2022-03-01 10:00:00 +01:00", "1"],
+        ["AD/SPO-AD0942A-0001", "NO2", "", "2022-03-01 11:00:00 +01:00", "1"],
+        ["AD/SPO-AD0942A-0001", "NO2", "13.1", "2022-03-01 12:00:00 +01:00", "-1"],
+        ["AD/SPO-AD0942A-0001", "NO2", "14.2", "2022-03-01 13:00:00 +01:00", "1"],
+        ["AD/SPO-AD9999A-0001", "NO2", "10.0", "2022-03-01 10:00:00 +01:00", "1"],
+        ["AD/SPO-AD0942A-0001", "NO2", "15.3", "2022-03-01 14:00:00 +01:00", "2"],
+    ],
+    ("DE", "5"): [
+        ["DE/SPO-DEBY001-0001", "PM10", "21.0", "2022-03-01 10:00:00 +01:00", "1"],
+    ],
+}
+
+
+class EEARequestHandler(FixtureRequestHandler):
+    """
+    Serve the station metadata CSV file, and the bulk download service.
+    """
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == "/metadata/PanEuropean_metadata.csv":
+            payload = "\n".join("\t".join(row) for row in [COLUMNS] + METADATA)
+        elif url.path == "/download":
+            query = parse_qs(url.query)
+            key = (query["CountryCode"][0], query["Pollutant"][0])
+            payload = ""
+            if key in MEASUREMENTS:
+                payload = f"http://127.0.0.1:{self.server.server_port}/files/{key[0]}_{key[1]}.csv\r\n"
+        elif url.path.startswith("/files/"):
+            key = tuple(url.path[7:-4].split("_"))
+            header = ["SamplingPoint", "AirPollutant", "Concentration", "UnitOfMeasurement"]
+            header += ["DatetimeBegin", "Validity"]
+            rows = [row[:3] + ["\u00b5g/m3"] + row[3:] for row in MEASUREMENTS[key]]
+            payload = "\ufeff" + "\r\n".join(",".join(row) for row in [header] + rows)
+        else:
+            self.send_error(404)
+            return
+        self.respond(payload, content_type="text/csv")
+
+
+@pytest.fixture
+def eea_api(http_server, monkeypatch):
+    monkeypatch.setattr(EEAAirQualityPumpe, "cache_enabled", False)
+    return http_server(EEARequestHandler)
+
+
+def test_stations(eea_api):
+    """
+    Stations are built from the metadata CSV, with one sensor per sampling point.
+    """
+    pump = EEAAirQualityPumpe()
+    pump.uri = eea_api
+    stations = pump.get_stations()
+
+    assert [station.station_id for station in stations] == ["AD0942A", "DEBY001"]
+    assert stations[0] == {
+        "station_id": "AD0942A",
+        "station_namespace": "AD.Government.AQ",
+        "station_network_code": "NET-AD001A",
+        "station_code": "STA-AD0942A",
+        "station_nat_code": "0942",
+        "station_eoi_code": "AD0942A",
+        "station_type": "background",
+        "station_area": "urban",
+        "position": {
+            "country": "AD",
+            "latitude": 42.509694,
+            "longitude": 1.539138,
+            "altitude": 1080.0,
+            "projection": "EPSG:4979",
+            "building_distance": 6.0,
+            "kerb_distance": -999.0,
+            "geohash": "sp91g48ubt26",
+        },
+        "sensors": [
+            {
+                "sensor_type_uri": "http://dd.eionet.europa.eu/vocabulary/aq/pollutant/1",
+                "sensor_measurement_type": "automatic",
+                "sensor_measurement_equipment": "",
+                "sensor_inlet_height": 3.0,
+                "sensor_equivalence_demonstrated": "ref",
+                "sensor_sampling_process": "SPP-AD0942A-0001",
+                "sensor_sampling_id": "SAM-AD0942A-0001",
+                "sensor_sampling_point": "SPO-AD0942A-0001",
+            },
+            {
+                "sensor_type_uri": "http://dd.eionet.europa.eu/vocabulary/aq/pollutant/5",
+                "sensor_measurement_type": "automatic",
+                "sensor_measurement_equipment": "",
+                "sensor_inlet_height": 3.0,
+                "sensor_equivalence_demonstrated": "ref",
+                "sensor_sampling_process": "SPP-AD0942A-0002",
+                "sensor_sampling_id": "SAM-AD0942A-0002",
+                "sensor_sampling_point": "SPO-AD0942A-0002",
+            },
+        ],
+    }
+    assert isinstance(stations[0].position, Munch)
+    assert [sensor.sensor_sampling_point for sensor in stations[1].sensors] == ["SPO-DEBY001-0001", "SPO-DEBY001-0002"]
+
+
+def test_stations_missing_coordinates(eea_api, monkeypatch):
+    """
+    Missing or invalid numeric values are decoded to `None`, and such stations are not geocoded.
+    """
+    record = sampling_point("LU", "LU0101A", 1, 5)
+    record[COLUMNS.index("Latitude")] = ""
+    record[COLUMNS.index("Altitude")] = "n/a"
+    monkeypatch.setattr("tests.test_eea.METADATA", [*METADATA, record])
+
+    pump = EEAAirQualityPumpe()
+    pump.uri = eea_api
+    stations = pump.get_stations()
+
+    assert [station.station_id for station in stations] == ["AD0942A", "DEBY001", "LU0101A"]
+    assert stations[2].position == {
+        "country": "LU",
+        "latitude": None,
+        "longitude": 1.539138,
+        "altitude": None,
+        "projection": "EPSG:4979",
+        "building_distance": 6.0,
+        "kerb_distance": -999.0,
+    }
+    json.dumps(stations, allow_nan=False)
+
+
+def test_stations_cache_backend(eea_api, monkeypatch, tmp_path):
+    """
+    HTTP responses can be cached within a local SQLite database.
+    """
+    monkeypatch.setattr(cache, "cache_directory", lambda: str(tmp_path))
+    monkeypatch.setattr(EEAAirQualityPumpe, "cache_enabled", True)
+    pump = EEAAirQualityPumpe(cache_backend="sqlite")
+    pump.uri = eea_api
+
+    assert len(pump.get_stations(conditional=False)) == 2
+    assert len(pump.get_stations(conditional=False)) == 2
+    assert pump.session.cache.responses.keys()
+    assert list(tmp_path.glob("http/*.sqlite"))
+
+
+def test_stations_filter(eea_api):
+    """
+    Stations can be filtered by country code.
+    """
+    pump = EEAAirQualityPumpe(filter=Munch(country=["DE"]))
+    pump.uri = eea_api
+    stations = pump.get_stations()
+    assert [station.station_id for station in stations] == ["DEBY001"]
+
+
+@pytest.mark.parametrize("chunksize", [2, 50000])
+def test_readings(eea_api, chunksize):
+    """
+    Measurements of the bulk download files are joined against the stations by sampling point,
+    skipping invalid measurements, and measurements of unknown sampling points.
+    """
+    pump = EEAAirQualityPumpe(source="api")
+    pump.uri = eea_api
+    pump.download_uri = eea_api + "download"
+    pump.chunksize = chunksize
+    readings = list(pump.get_readings())
+
+    assert all(isinstance(reading.station, Munch) and "sensors" not in reading.station for reading in readings)
+    observations = [
+        (reading.station.station_id, observation.meta.timestamp, observation.data)
+        for reading in readings
+        for observation in reading.observations
+    ]
+    assert observations == [
+        ("AD0942A", "2022-03-01T10:00:00+01:00", {"no2": 12.4}),
+        ("AD0942A", "2022-03-01T13:00:00+01:00", {"no2": 14.2}),
+        ("AD0942A", "2022-03-01T14:00:00+01:00", {"no2": 15.3}),
+        ("DEBY001", "2022-03-01T10:00:00+01:00", {"pm10": 21.0}),
+    ]
+
+
+def test_readings_incremental(eea_api, monkeypatch, tmp_path):
+    """
+    In incremental mode, measurements not newer than the cursor of their sampling point
+    are skipped, but only after state has been committed.
+    """
+    store = StateStore.from_directory(str(tmp_path))
+
+    def acquire():
+        pump = EEAAirQualityPumpe(source="api", state=store, incremental=True, domain="readings")
+        pump.uri = eea_api
+        pump.download_uri = eea_api + "download"
+        readings = list(pump.get_readings())
+        return pump, [observation.meta.timestamp for reading in readings for observation in reading.observations]
+
+    pump, timestamps = acquire()
+    assert len(timestamps) == 4
+    pump, timestamps = acquire()
+    assert len(timestamps) == 4
+    pump.commit()
+
+    pump, timestamps = acquire()
+    assert timestamps == []
+
+    measurement = ["AD/SPO-AD0942A-0001", "NO2", "16.4", "2022-03-01 15:00:00 +01:00", "1"]
+    monkeypatch.setitem(MEASUREMENTS, ("AD", "8"), [*MEASUREMENTS[("AD", "8")], measurement])
+    pump, timestamps = acquire()
+    assert timestamps == ["2022-03-01T15:00:00+01:00"]
+    pump.commit()
+    assert store.load("eea:cursors:readings") == {
+        "AD/SPO-AD0942A-0001": 1646143200000,
+        "DE/SPO-DEBY001-0001": 1646125200000,
+    }
+
+
+def test_readings_enrichment(eea_api, monkeypatch):
+    """
+    Only stations having measurements are enriched.
+    """
+    monkeypatch.setattr("tests.test_eea.METADATA", [*METADATA, sampling_point("LU", "LU0101A", 1, 5)])
+    enriched = []
+    monkeypatch.setattr(EEAAirQualityPumpe, "enrich_station", lambda self, station: enriched.append(station.station_id))
+    pump = EEAAirQualityPumpe(source="api")
+    pump.uri = eea_api
+    pump.download_uri = eea_api + "download"
+    assert len(list(pump.get_readings())) == 2
+    assert enriched == ["AD0942A", "DEBY001"]
@@ -0,0 +1,126 @@
+import threading
+import time
+
+import pytest
+
+from luftdatenpumpe.engine import FlushPolicy, LuftdatenEngine
+from luftdatenpumpe.target.threaded import ThreadedTarget
+
+
+class RecordingTarget:
+    def __init__(self):
+        self.capabilities = ["readings"]
+        self.items = []
+        self.flushed = []
+        self.threads = set()
+
+    def emit(self, item):
+        self.threads.add(threading.current_thread().name)
+        self.items.append(item)
+
+    def flush(self, final=False):
+        self.flushed.append(final)
+
+
+class FailingTarget(RecordingTarget):
+    def emit(self, item):
+        raise ValueError("Something failed")
+
+
+def test_threaded_target_drains_on_final_flush():
+    """
+    Items emitted to a concurrent target are processed on its worker thread,
+    and are all available after the final flush.
+    """
+    target = RecordingTarget()
+    threaded = ThreadedTarget(target, queue_size=2)
+    for item in range(42):
+        threaded.emit(item)
+    threaded.flush()
+    threaded.flush(final=True)
+
+    assert target.items == list(range(42))
+    assert target.flushed == [False, True]
+    assert target.threads == {"target-RecordingTarget"}
+    assert threaded.capabilities == ["readings"]
+
+    threaded.close()
+    assert not threaded.thread.is_alive()
+
+
+def test_threaded_target_propagates_errors():
+    """
+    Errors on the worker thread are re-raised on the main thread.
+    """
+    threaded = ThreadedTarget(FailingTarget())
+    threaded.emit(1)
+    with pytest.raises(ValueError) as ex:
+        threaded.flush(final=True)
+    assert ex.match("Something failed")
+    threaded.close()
+
+
+class FailingFlushTarget(RecordingTarget):
+    def flush(self, final=False):
+        raise ValueError("Flushing failed")
+
+
+def test_engine_finalizes_all_targets():
+    """
+    When the final flush of one data sink fails, all other data sinks are still
+    flushed, the worker threads are shut down, and the error is re-raised.
+    """
+    failing = ThreadedTarget(FailingFlushTarget())
+    target = RecordingTarget()
+    threaded = ThreadedTarget(target)
+    engine = LuftdatenEngine(network="ldi", domain="readings", targets=[])
+    engine.sinks = [(failing, FlushPolicy(items=1000)), (threaded, FlushPolicy(items=1000))]
+
+    with pytest.raises(ValueError) as ex:
+        engine.process([{"id": 1}, {"id": 2}])
+    assert ex.match("Flushing failed")
+    assert target.items == [{"id": 1}, {"id": 2}]
+    assert target.flushed == [True]
+    assert not failing.thread.is_alive()
+    assert not threaded.thread.is_alive()
+
+    # The data sinks can be reused on the next invocation.
+    engine.sinks = [(threaded, FlushPolicy(items=1000))]
+    engine.process([{"id": 3}])
+    assert target.items == [{"id": 1}, {"id": 2}, {"id": 3}]
+    assert not threaded.thread.is_alive()
+
+
+def test_flush_policy_derive():
+    """
+    Flush thresholds can be configured per data sink, using query parameters.
+    """
+    defaults = FlushPolicy(points=1000, latency=5)
+    policy, expression = defaults.derive("influxdb://localhost/luftdaten_info?batch-points=5000&batch-bytes=1024")
+    assert expression == "influxdb://localhost/luftdaten_info"
+    assert (policy.items, policy.points, policy.bytes, policy.latency) == (None, 5000, 1024, 5)
+
+    policy, expression = defaults.derive("postgresql://localhost/weatherbase?sslmode=require")
+    assert expression == "postgresql://localhost/weatherbase?sslmode=require"
+    assert (policy.items, policy.points, policy.bytes, policy.latency) == (None, 1000, None, 5)
+
+
+def test_flush_policy_due():
+    """
+    A flush is due when any of the configured thresholds is exceeded.
+    """
+    policy = FlushPolicy(points=24, bytes=100)
+    assert not policy.due()
+    policy.account(points=12, size=40)
+    assert not policy.due()
+    policy.account(points=12, size=40)
+    assert policy.due()
+    policy.reset()
+    policy.account(points=1, size=120)
+    assert policy.due()
+
+    policy = FlushPolicy(latency=0.01)
+    policy.account()
+    assert not policy.due()
+    time.sleep(0.02)
+    assert policy.due()
@@ -0,0 +1,272 @@
+import threading
+import time
+
+import pytest
+from docopt import DocoptExit
+from munch import Munch
+
+from luftdatenpumpe import geo
+from luftdatenpumpe.commands import run
+from luftdatenpumpe.geo import (
+    LocationIndex,
+    LRUCache,
+    TokenBucket,
+    configure_nearby_index,
+    configure_nominatim_cache,
+    export_nominatim_cache,
+    haversine_distance,
+    import_nominatim_cache,
+    nominatim_cache,
+    rebundle_location,
+    resolve_location,
+    resolve_locations,
+)
+from luftdatenpumpe.source.common import AbstractLuftdatenPumpe
+from tests.test_ldi_archive import DHT22_CSV, SDS011_CSV
+
+
+class FakeReverseGeocoder:
+    """
+    Emulate responses of the Nominatim reverse geocoder, counting requests.
+    """
+
+    def __init__(self):
+        self.requests = []
+        self.lock = threading.Lock()
+
+    def __call__(self, latitude, longitude, country_code):
+        with self.lock:
+            self.requests.append((latitude, longitude, country_code))
+        if latitude < 0:
+            raise ValueError(f"Reverse geocoding failed for lat={latitude}, lon={longitude}")
+        return {
+            "display_name": f"Road {latitude}, Stuttgart",
+            "address": {"road": f"Road {latitude}", "city": "Stuttgart", "country_code": "de"},
+        }
+
+
+def test_token_bucket():
+    """
+    The token bucket permits a burst of up to its capacity, then limits the rate across threads.
+    """
+    bucket = TokenBucket(rate=20, capacity=2)
+    started = time.monotonic()
+    threads = [threading.Thread(target=bucket.acquire) for _ in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert 0.18 <= time.monotonic() - started < 1
+
+
+def test_lru_cache():
+    """
+    The in-memory cache evicts the least recently used entries, and counts hits and misses.
+    """
+    cache = LRUCache(maxsize=2)
+    calls = []
+
+    @cache.cache_on_arguments()
+    def square(number):
+        calls.append(number)
+        return number * number
+
+    assert [square(2), square(3), square(2), square(4), square(3), square(2)] == [4, 9, 4, 16, 9, 4]
+    assert calls == [2, 3, 4, 3, 2]
+    assert (cache.hits, cache.misses) == (1, 5)
+    assert list(cache.entries) == ["tests.test_geo:square|3", "tests.test_geo:square|2"]
+
+
+def test_rebundle_location_immutable():
+    """
+    Rebundling a location leaves the original, possibly cached, location untouched.
+    """
+    raw = {"place_id": 42, "address": {"road": "Hauptstraße", "city": "Stuttgart", "building": "Arena"}}
+    location = rebundle_location(raw)
+    assert location == {
+        "place_id": 42,
+        "address": {"road": "Hauptstraße", "city": "Stuttgart"},
+        "address_more": {"building": "Arena"},
+    }
+    assert raw == {"place_id": 42, "address": {"road": "Hauptstraße", "city": "Stuttgart", "building": "Arena"}}
+
+
+def test_resolve_locations(monkeypatch):
+    """
+    Each distinct position is resolved once, failures are mapped to their exception.
+    """
+    geocoder = FakeReverseGeocoder()
+    monkeypatch.setattr(geo, "reverse_geocode", geocoder)
+
+    positions = [(48.7, 9.2, "DE"), (48.8, 9.1, "DE"), (48.7, 9.2, "DE"), (-1.0, 9.2, "DE")]
+    locations = resolve_locations(positions, workers=4)
+
+    assert sorted(geocoder.requests) == sorted(set(positions))
+    assert locations[(48.7, 9.2, "DE")].address.road == "Road 48.7"
+    assert locations[(48.8, 9.1, "DE")].address.road == "Road 48.8"
+    assert isinstance(locations[(-1.0, 9.2, "DE")], ValueError)
+
+
+def test_enrich_batch(monkeypatch):
+    """
+    Stations of readings are enriched in batches, reverse geocoding each distinct position once.
+    """
+    geocoder = FakeReverseGeocoder()
+    monkeypatch.setattr(geo, "reverse_geocode", geocoder)
+
+    def reading(station_id, latitude):
+        return Munch(
+            station=Munch(station_id=station_id, position=Munch(latitude=latitude, longitude=9.2, country="DE")),
+            observations=[],
+        )
+
+    pump = AbstractLuftdatenPumpe(reverse_geocode=True)
+    pump.geocoding_batch_size = 2
+    items = [reading(1, 48.7), reading(2, 48.8), reading(1, 48.7), reading(3, -1.0), reading(1, 48.7)]
+    enriched = list(pump.enrich_batch(iter(items), workers=2))
+
+    assert enriched == items
+    assert len(geocoder.requests) == 5
+    assert [item.station.name for item in enriched] == [
+        "Road 48.7, Stuttgart, DE",
+        "Road 48.8, Stuttgart, DE",
+        "Road 48.7, Stuttgart, DE",
+        "Station #3, DE",
+        "Road 48.7, Stuttgart, DE",
+    ]
+    assert enriched[0].station.position.geohash == "u0wt13e4p9cp"
+
+
+def test_location_index():
+    """
+    The spatial index finds the nearest known location within the configured distance.
+    """
+    index = LocationIndex(distance=50)
+    index.add(48.77800, 9.23600, "A")
+    index.add(48.77830, 9.23600, "B")
+    index.add(48.77900, 9.23600, "C")
+
+    assert round(haversine_distance(48.778, 9.236, 48.7783, 9.236)) == 33
+    assert index.nearest(48.77810, 9.23600) == "A"
+    assert index.nearest(48.77825, 9.23600) == "B"
+    assert index.nearest(48.77870, 9.23600) == "C"
+    assert index.nearest(48.77960, 9.23600) is None
+    assert index.nearest(52.5, 13.4) is None
+
+
+def test_location_index_bucket_boundary():
+    """
+    Locations in neighbouring buckets are found, also across the antimeridian.
+    """
+    index = LocationIndex(distance=100, precision=8)
+    index.add(0.0, 179.9999, "east")
+    index.add(0.0001, -179.9999, "west")
+    assert index.nearest(0.0, -179.9998) == "west"
+    assert index.nearest(0.0, 179.9998) == "east"
+    assert index.nearest(0.0, 180.0) in ["east", "west"]
+
+
+def test_location_index_precision():
+    """
+    The bucket size is derived from the distance, so only a few buckets are inspected per lookup.
+    """
+    assert [LocationIndex.precision_for(distance) for distance in [10, 50, 500, 5000, 50000]] == [8, 7, 6, 4, 3]
+    for distance in [10, 50, 500, 5000, 50000]:
+        index = LocationIndex(distance, precision=LocationIndex.precision_for(distance))
+        assert len(index.cells(48.778, 9.236)) <= 12
+        index.add(48.778, 9.236, "A")
+        assert index.nearest(48.778, 9.236) == "A"
+
+
+@pytest.fixture
+def memory_cache(monkeypatch):
+    configure_nominatim_cache("memory")
+    monkeypatch.setattr(geo, "nearby_index", None)
+    yield
+    configure_nominatim_cache("redis")
+
+
+def test_nearby_index_from_cache(memory_cache, monkeypatch):
+    """
+    Locations of nearby positions within the Nominatim cache are reused, without querying Nominatim.
+    """
+    raw = {"place_id": 42, "address": {"road": "Ulmer Straße", "city": "Stuttgart", "building": "Arena"}}
+    nominatim_cache.set("luftdatenpumpe.geo:reverse_geocode|DE 48.778 9.236", raw)
+    configure_nearby_index(25, locations=[(52.544, 13.374, {"place_id": 43, "address": {"city": "Berlin"}})])
+    assert len(geo.nearby_index) == 2
+
+    def fail(*args):
+        raise AssertionError("Nominatim should not be queried")
+
+    monkeypatch.setattr(geo, "reverse_geocode", fail)
+    location = resolve_location(latitude=48.7781, longitude=9.2361, country_code="DE")
+    assert location.address == {"road": "Ulmer Straße", "city": "Stuttgart"}
+    assert location.address_more == {"building": "Arena"}
+    assert resolve_location(latitude=52.5441, longitude=13.374).address.city == "Berlin"
+
+
+def test_nearby_index_learns(memory_cache, monkeypatch):
+    """
+    Locations resolved by Nominatim are added to the index.
+    """
+    configure_nearby_index(25)
+    geocoder = FakeReverseGeocoder()
+    monkeypatch.setattr(geo, "reverse_geocode", geocoder)
+    resolve_location(latitude=48.7, longitude=9.2)
+    resolve_location(latitude=48.7001, longitude=9.2001)
+    assert len(geocoder.requests) == 1
+
+
+def test_export_import(memory_cache, tmp_path):
+    """
+    The Nominatim cache can be exported to a compressed file, and imported again.
+    """
+    entries = {
+        "luftdatenpumpe.geo:reverse_geocode|DE 48.778 9.236": {"place_id": 42, "address": {"city": "Stuttgart"}},
+        "luftdatenpumpe.geo:reverse_geocode|None 52.544 13.374": {"place_id": 43, "address": {"city": "Berlin"}},
+    }
+    nominatim_cache.set_multi(entries)
+    path = str(tmp_path / "geocache.jsonl.gz")
+    assert export_nominatim_cache(path) == 2
+
+    configure_nominatim_cache("memory")
+    assert not list(geo.cached_locations())
+    assert import_nominatim_cache(path) == 2
+    assert dict(geo.cached_locations()) == entries
+
+
+def test_geocache_warm(memory_cache, monkeypatch, tmp_path):
+    """
+    The positions of all stations are reverse geocoded when warming up the cache.
+    """
+    (tmp_path / "2016-07-14_sds011_sensor_92.csv").write_text(SDS011_CSV)
+    (tmp_path / "2016-08-13_dht22_sensor_48.csv").write_text(DHT22_CSV)
+    geocoder = FakeReverseGeocoder()
+    monkeypatch.setattr(geo, "reverse_geocode", geocoder)
+    monkeypatch.setattr(
+        "sys.argv",
+        [
+            "luftdatenpumpe",
+            "geocache",
+            "warm",
+            "--network=ldi",
+            f"--source=file://{tmp_path}",
+            "--cache-backend=memory",
+            f"--state-dir={tmp_path}",
+            "--geocode-workers=2",
+        ],
+    )
+    with pytest.raises(SystemExit):
+        run()
+    assert sorted(geocoder.requests) == [(48.722, 9.209, None), (48.8, 9.003, None)]
+
+
+def test_geocache_invalid_backend(monkeypatch, tmp_path):
+    """
+    An invalid cache backend is rejected before exporting or importing the cache.
+    """
+    path = str(tmp_path / "geocache.jsonl")
+    monkeypatch.setattr("sys.argv", ["luftdatenpumpe", "geocache", "export", path, "--cache-backend=foo"])
+    with pytest.raises(DocoptExit) as ex:
+        run()
+    assert ex.match("--cache-backend parameter must be one of")
@@ -0,0 +1,280 @@
+import json
+import re
+import socket
+
+import pytest
+from munch import Munch
+
+from luftdatenpumpe.source.irceline import IrcelinePumpe
+from luftdatenpumpe.state import StateStore
+from tests.conftest import FixtureRequestHandler
+
+# 2019-04-24T00:00:00Z, in milliseconds.
+EPOCH = 1556064000000
+HOUR = 3600 * 1000
+
+
+def make_timeseries(timeseries_id, phenomenon_id, phenomenon_label):
+    properties = {}
+    for name in ["service", "offering", "feature", "procedure"]:
+        properties[name] = {"id": str(timeseries_id), "label": f"{name} {timeseries_id}"}
+    for name in ["category", "phenomenon"]:
+        properties[name] = {"id": str(phenomenon_id), "label": phenomenon_label}
+    return properties
+
+
+STATIONS = [
+    {
+        "properties": {
+            "id": 1030,
+            "label": "40AL01 - Linkeroever",
+            "timeseries": {
+                "6151": make_timeseries(6151, 5, "Particulate Matter < 10 µm"),
+                "6152": make_timeseries(6152, 6001, "Particulate Matter < 2.5 µm"),
+            },
+        },
+        "geometry": {"coordinates": [4.385, 51.236]},
+    },
+    {
+        "properties": {
+            "id": 1751,
+            "label": "42R010 - Sint-Jans-Molenbeek",
+            "timeseries": {
+                "7001": make_timeseries(7001, 5, "Particulate Matter < 10 µm"),
+            },
+        },
+        "geometry": {"coordinates": [4.34, 50.848]},
+    },
+]
+
+VALUES = {
+    "6151": [{"timestamp": EPOCH, "value": 10.0}, {"timestamp": EPOCH + HOUR, "value": 11.0}],
+    "6152": [{"timestamp": EPOCH, "value": 5.0}, {"timestamp": EPOCH + 2 * HOUR, "value": 6.0}],
+    "7001": [{"timestamp": EPOCH + HOUR, "value": 20.0}, {"timestamp": EPOCH + 2 * HOUR, "value": "NaN"}],
+}
+
+
+class SosRequestHandler(FixtureRequestHandler):
+    """
+    Emulate the IRCELINE SOS REST API.
+
+    ``failing`` holds timeseries identifiers the server will fail on, using
+    ``failing_status``, ``requests`` is a log of all requests. All of them are
+    reset by the fixture.
+    """
+
+    def do_GET(self):
+        path = self.path.split("?")[0]
+        self.requests.append(("GET", path))
+        if path.endswith("/stations"):
+            return self.respond(STATIONS)
+        if path.endswith("/timeseries/"):
+            index = [
+                {"id": identifier, "firstValue": values[0], "lastValue": values[-1]}
+                for identifier, values in VALUES.items()
+            ]
+            return self.respond(index)
+        m = re.match(r".+/timeseries/(\d+)/getData$", path)
+        if m:
+            return self.respond_data([m.group(1)])
+        self.respond({"userMessage": "Not found"}, status=404)
+
+    def do_POST(self):
+        path = self.path.split("?")[0]
+        payload = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        self.requests.append(("POST", path))
+        if path.endswith("/timeseries/getData"):
+            return self.respond_data([str(identifier) for identifier in payload["timeseries"]])
+        self.respond({"userMessage": "Not found"}, status=404)
+
+    def respond_data(self, identifiers):
+        if self.failing.intersection(identifiers):
+            return self.respond({"userMessage": "Failed"}, status=self.failing_status)
+        self.respond({identifier: {"values": VALUES[identifier]} for identifier in identifiers})
+
+
+@pytest.fixture
+def sos_api(http_server):
+    SosRequestHandler.failing = set()
+    SosRequestHandler.failing_status = 400
+    SosRequestHandler.requests = []
+    return http_server(SosRequestHandler, "/sos/api/v1/")
+
+
+def make_pump(uri, **kwargs):
+    pump = IrcelinePumpe(**kwargs)
+    pump.uri = uri
+    return pump
+
+
+def test_readings(sos_api):
+    """
+    Values of all timeseries of a station are grouped by timestamp, ascending.
+    """
+    pump = make_pump(sos_api, filter=Munch())
+    readings = pump.get_readings_from_api()
+    assert [reading.station.station_id for reading in readings] == [1030, 1751]
+    assert "sensors" not in readings[0].station
+
+    def summarize(reading):
+        return [(observation.meta.timestamp, observation.data) for observation in reading.observations]
+
+    timestamp = pump.convert_timestamp
+    assert summarize(readings[0]) == [
+        (timestamp(EPOCH), {"particulate-matter-10-m": 10.0, "particulate-matter-2-5-m": 5.0}),
+        (timestamp(EPOCH + HOUR), {"particulate-matter-10-m": 11.0}),
+        (timestamp(EPOCH + 2 * HOUR), {"particulate-matter-2-5-m": 6.0}),
+    ]
+    assert summarize(readings[1]) == [(timestamp(EPOCH + HOUR), {"particulate-matter-10-m": 20.0})]
+
+
+@pytest.mark.parametrize("concurrency", [None, 4])
+def test_timeseries_details(sos_api, concurrency, caplog):
+    """
+    Timeseries are requested concurrently, logging errors per timeseries.
+    """
+    SosRequestHandler.failing = {"6152"}
+    pump = make_pump(sos_api, concurrency=concurrency)
+    results = pump.get_timeseries_details(timeseries_ids=[7001, 6151, 6152], timespan="PT12h/2019-04-24T03:00:00Z")
+    assert results == {"6151": {"values": VALUES["6151"]}, "7001": {"values": VALUES["7001"]}}
+    assert "Requesting data for timeseries 6152 failed" in caplog.text
+
+
+def test_timeseries_bulk(sos_api, caplog):
+    """
+    Timeseries are requested in bulk, bisecting chunks to isolate failing timeseries.
+    """
+    SosRequestHandler.failing = {"6152"}
+    pump = make_pump(sos_api, bulk=True)
+    results = pump.get_timeseries_details(timeseries_ids=[7001, 6151, 6152], timespan="PT12h/2019-04-24T03:00:00Z")
+    assert results == {"6151": {"values": VALUES["6151"]}, "7001": {"values": VALUES["7001"]}}
+    assert "Requesting data for timeseries 6152 failed" in caplog.text
+
+    # [6151, 6152, 7001] -> [6151], [6152, 7001] -> [6152], [7001]
+    assert len(SosRequestHandler.requests) == 5
+
+
+def test_timeseries_bulk_server_error(sos_api, caplog):
+    """
+    Server errors do not abort requesting timeseries in bulk,
+    chunks are bisected like on client errors.
+    """
+    SosRequestHandler.failing = {"6152"}
+    SosRequestHandler.failing_status = 503
+    pump = make_pump(sos_api, bulk=True)
+    results = pump.get_timeseries_details(timeseries_ids=[7001, 6151, 6152], timespan="PT12h/2019-04-24T03:00:00Z")
+    assert results == {"6151": {"values": VALUES["6151"]}, "7001": {"values": VALUES["7001"]}}
+    assert "Requesting data for timeseries 6152 failed: 503 Server Error" in caplog.text
+    assert len(SosRequestHandler.requests) == 5
+
+
+def test_timeseries_bulk_connection_error(monkeypatch, caplog):
+    """
+    Connection errors do not abort requesting timeseries in bulk.
+    """
+    monkeypatch.setattr(IrcelinePumpe, "http_backoff_factor", 0)
+    with socket.socket() as sock:
+        sock.bind(("localhost", 0))
+        port = sock.getsockname()[1]
+    pump = make_pump(f"http://localhost:{port}/sos/api/v1/", bulk=True)
+    results = pump.get_timeseries_details(timeseries_ids=[7001, 6151, 6152], timespan="PT12h/2019-04-24T03:00:00Z")
+    assert results == {}
+    assert "Requesting data for timeseries 6152 failed" in caplog.text
+
+
+def test_readings_incremental(sos_api, tmp_path, monkeypatch):
+    """
+    In incremental mode, only timeseries with new values are requested,
+    and only new values are emitted, but only after state has been committed.
+    """
+    store = StateStore.from_directory(str(tmp_path))
+
+    def acquire():
+        SosRequestHandler.requests = []
+        pump = make_pump(sos_api, filter=Munch(), state=store, incremental=True, domain="readings")
+        readings = pump.get_readings_from_api()
+        requested = sorted(path for method, path in SosRequestHandler.requests if path.endswith("/getData"))
+        return pump, readings, requested
+
+    pump, readings, requested = acquire()
+    assert [len(reading.observations) for reading in readings] == [3, 1]
+    assert len(requested) == 3
+    pump.commit()
+
+    pump, readings, requested = acquire()
+    assert readings == []
+    assert requested == []
+
+    monkeypatch.setitem(VALUES, "6151", VALUES["6151"] + [{"timestamp": EPOCH + 3 * HOUR, "value": 12.0}])
+    pump, readings, requested = acquire()
+    assert requested == ["/sos/api/v1/timeseries/6151/getData"]
+    assert len(readings) == 1
+    assert readings[0].station.station_id == 1030
+    assert [observation.data for observation in readings[0].observations] == [{"particulate-matter-10-m": 12.0}]
+
+
+def test_select_unprocessed_timespan(tmp_path):
+    """
+    In incremental mode, the timespan starts at the oldest cursor of all selected
+    timeseries, falling back to the default timespan for timeseries without a cursor,
+    and limited to the maximum timespan.
+    """
+    this_hour = IrcelinePumpe.this_hour(as_datetime=True).timestamp() * 1000
+    store = StateStore.from_directory(str(tmp_path))
+    store.update("irceline:cursors:readings", {"6151": this_hour - 2 * HOUR, "7001": this_hour - HOUR})
+    index = {
+        6151: Munch(lastValue=Munch(timestamp=this_hour)),
+        6152: Munch(lastValue=Munch(timestamp=this_hour)),
+        7001: Munch(lastValue=Munch(timestamp=this_hour)),
+    }
+
+    pump = IrcelinePumpe(state=store, incremental=True, domain="readings")
+    selected, timespan = pump.select_unprocessed([6151, 7001], index)
+    assert selected == [6151, 7001]
+    assert timespan == f"{pump.convert_timestamp(this_hour - 2 * HOUR)}/{pump.this_hour()}"
+
+    selected, timespan = pump.select_unprocessed([6151, 6152, 7001], index)
+    assert selected == [6151, 6152, 7001]
+    assert timespan == f"{pump.convert_timestamp(this_hour - 12 * HOUR)}/{pump.this_hour()}"
+
+    store.update("irceline:cursors:readings", {"6152": this_hour - 90 * 24 * HOUR})
+    pump = IrcelinePumpe(state=store, incremental=True, domain="readings")
+    selected, timespan = pump.select_unprocessed([6151, 6152, 7001], index)
+    assert selected == [6151, 6152, 7001]
+    assert timespan == f"{pump.convert_timestamp(this_hour - 48 * HOUR)}/{pump.this_hour()}"
+
+
+def test_metadata_cache(sos_api, tmp_path):
+    """
+    Station metadata is cached between invocations, also serving filtered requests.
+    """
+    store = StateStore.from_directory(str(tmp_path))
+
+    def acquire(**kwargs):
+        SosRequestHandler.requests = []
+        pump = make_pump(sos_api, state=store, metadata_ttl=3600, **kwargs)
+        readings = pump.get_readings_from_api()
+        requested = sorted(path for method, path in SosRequestHandler.requests if not path.endswith("/getData"))
+        return readings, requested
+
+    readings, requested = acquire(filter=Munch())
+    assert requested == ["/sos/api/v1/stations", "/sos/api/v1/timeseries/"]
+
+    cached_readings, requested = acquire(filter=Munch())
+    assert requested == []
+    assert cached_readings == readings
+
+    readings, requested = acquire(filter=Munch(station=[1751]))
+    assert requested == []
+    assert [reading.station.station_id for reading in readings] == [1751]
+
+    # Filtering by country is rejected like for upstream data.
+    readings, requested = acquire(filter=Munch(country=["BE"], station=[1751]))
+    assert [reading.station.station_id for reading in readings] == [1751]
+    with pytest.raises(NotImplementedError):
+        acquire(filter=Munch(country=["DE"]))
+
+    # An expired cache is refreshed.
+    store.update("irceline:metadata", {"info": {"updated": 0, "reverse-geocode": False}})
+    readings, requested = acquire(filter=Munch())
+    assert requested == ["/sos/api/v1/stations", "/sos/api/v1/timeseries/"]
@@ -0,0 +1,253 @@
+import gzip
+import io
+import os
+import zipfile
+
+import pytest
+
+from luftdatenpumpe.source import luftdaten_info
+from luftdatenpumpe.source.luftdaten_info import LuftdatenPumpe
+from luftdatenpumpe.state import StateStore
+
+SDS011_CSV = """sensor_id;sensor_type;location;lat;lon;timestamp;P1;durP1;ratioP1;P2;durP2;ratioP2
+92;SDS011;42;48.800;9.003;2016-07-14T13:02:46.949036+00:00;7.71;;;5.03;;
+92;SDS011;42;48.800;9.003;2016-07-14T13:05:12.108352+00:00;8.12;;;nan;;
+92;SDS011;42;48.800;9.003;2016-07-14T13:07:40.234012+00:00;;;;;;
+"""
+
+DHT22_CSV = """sensor_id;sensor_type;location;lat;lon;timestamp;temperature;humidity
+48;DHT22;19;48.722;9.209;2016-08-13T00:00:26.053188+00:00;21.30;45.10
+48;DHT22;19;48.722;9.209;2016-08-13T00:03:02.190371+00:00;21.20;
+48;DHT22;foo;48.722;9.209;2016-08-13T00:05:38.298814+00:00;21.10;45.30
+"""
+
+
+@pytest.fixture
+def archive(tmp_path):
+    """
+    A miniature version of the CSV archive of luftdaten.info.
+    """
+    for day in ["2016-07-14", "2016-08-13"]:
+        (tmp_path / day).mkdir()
+    (tmp_path / "2016-07-14" / "2016-07-14_sds011_sensor_92.csv").write_text(SDS011_CSV)
+    (tmp_path / "2016-08-13" / "2016-08-13_dht22_sensor_48.csv").write_text(DHT22_CSV)
+    return tmp_path
+
+
+def summarize(readings):
+    return [(reading.observations[0].meta.timestamp, dict(reading.observations[0].data)) for reading in readings]
+
+
+def test_decode_csv():
+    """
+    Readings are decoded from CSV records, skipping empty, missing and invalid
+    numeric fields, and records without any data.
+    """
+    pump = LuftdatenPumpe()
+    pump.enrichment_deferred = True
+    stream = io.StringIO(
+        "sensor_id;sensor_type;location;lat;lon;timestamp;P1;durP1;ratioP1\n"
+        "92;SDS011;42;48.800;9.003;2016-07-14T13:02:46.949036+00:00;7.71;;\n"
+        "92;SDS011;42;;;2016-07-14 13:05:12;foo;;\n"
+        "92;SDS011;42;;;2016-07-14 13:07:40;8.12;;\n"
+        "92;SDS011;42;48.800;9.003;2016-07-14 13:10:08;\n"
+    )
+    readings = list(pump.decode_csv(stream, ["P0", "P1", "P2"]))
+    assert [reading.station for reading in readings] == [
+        {"station_id": 42, "position": {"latitude": 48.8, "longitude": 9.003}},
+        {"station_id": 42, "position": {}},
+    ]
+    assert [reading.observations for reading in readings] == [
+        [
+            {
+                "meta": {
+                    "timestamp": "2016-07-14T13:02:46.949036+00:00",
+                    "sensor_id": 92,
+                    "sensor_type_name": "SDS011",
+                    "sensor_type_id": None,
+                },
+                "data": {"P1": 7.71},
+            }
+        ],
+        [
+            {
+                "meta": {
+                    "timestamp": "2016-07-14T13:07:40Z",
+                    "sensor_id": 92,
+                    "sensor_type_name": "SDS011",
+                    "sensor_type_id": None,
+                },
+                "data": {"P1": 8.12},
+            }
+        ],
+    ]
+
+
+def test_decode_csv_invalid():
+    """
+    Empty CSV files yield no readings, while those lacking metadata columns are rejected.
+    """
+    pump = LuftdatenPumpe()
+    assert list(pump.decode_csv(io.StringIO(""), ["temperature"])) == []
+    with pytest.raises(ValueError) as ex:
+        list(pump.decode_csv(io.StringIO("sensor_id;temperature\n48;21.3\n"), ["temperature"]))
+    assert ex.match("lacks columns")
+
+
+def test_archive_readings(archive):
+    """
+    Readings are decoded from CSV files, skipping records without data or with invalid data.
+    """
+    pump = LuftdatenPumpe()
+    readings = list(pump.get_readings_from_csv(str(archive)))
+    assert summarize(readings) == [
+        ("2016-07-14T13:02:46.949036+00:00", {"P1": 7.71, "P2": 5.03}),
+        ("2016-07-14T13:05:12.108352+00:00", {"P1": 8.12}),
+        ("2016-08-13T00:00:26.053188+00:00", {"temperature": 21.3, "humidity": 45.1}),
+        ("2016-08-13T00:03:02.190371+00:00", {"temperature": 21.2}),
+    ]
+    assert readings[0].station == {
+        "station_id": 42,
+        "position": {"latitude": 48.8, "longitude": 9.003, "geohash": "u0wmsggb9576"},
+    }
+
+
+def test_archive_readings_compressed(tmp_path):
+    """
+    Readings are decoded from gzip-compressed CSV files and CSV files within ZIP bundles,
+    also when filtering by sensor identifier.
+    """
+    with gzip.open(tmp_path / "2016-07-14_sds011_sensor_92.csv.gz", "wt") as f:
+        f.write(SDS011_CSV)
+    with zipfile.ZipFile(tmp_path / "2016-08.zip", "w") as bundle:
+        bundle.writestr("2016-08-13_dht22_sensor_48.csv", DHT22_CSV)
+        bundle.writestr("2016-08-13_dht22_sensor_49.csv", DHT22_CSV.replace("48;", "49;"))
+
+    pump = LuftdatenPumpe()
+    readings = list(pump.get_readings_from_csv(str(tmp_path)))
+    assert len(readings) == 6
+
+    pump = LuftdatenPumpe(filter={"sensor": [48, 92]})
+    readings = list(pump.get_readings_from_csv(str(tmp_path)))
+    assert summarize(readings) == [
+        ("2016-07-14T13:02:46.949036+00:00", {"P1": 7.71, "P2": 5.03}),
+        ("2016-07-14T13:05:12.108352+00:00", {"P1": 8.12}),
+        ("2016-08-13T00:00:26.053188+00:00", {"temperature": 21.3, "humidity": 45.1}),
+        ("2016-08-13T00:03:02.190371+00:00", {"temperature": 21.2}),
+    ]
+    assert {reading.observations[0].meta.sensor_id for reading in readings} == {48, 92}
+
+
+def test_archive_stations(archive):
+    """
+    Stations are derived from readings, listing each sensor once.
+    """
+    pump = LuftdatenPumpe(source=f"file://{archive}")
+    stations = list(pump.get_stations())
+    assert [(station.station_id, station.sensors) for station in stations] == [
+        (19, [{"sensor_id": 48, "sensor_type_name": "DHT22", "sensor_type_id": None}]),
+        (42, [{"sensor_id": 92, "sensor_type_name": "SDS011", "sensor_type_id": None}]),
+    ]
+
+
+@pytest.mark.parametrize("unordered", [False, True])
+def test_archive_readings_workers(archive, unordered):
+    """
+    Decoding CSV files using worker processes yields the same readings.
+    """
+    expected = list(LuftdatenPumpe().get_readings_from_csv(str(archive)))
+
+    pump = LuftdatenPumpe(workers=2, unordered=unordered)
+    readings = list(pump.get_readings_from_csv(str(archive)))
+    if unordered:
+        readings = sorted(readings, key=lambda reading: reading.observations[0].meta.timestamp)
+    assert readings == expected
+
+
+def test_archive_incremental(archive, tmp_path_factory):
+    """
+    In incremental mode, files ingested by previous invocations are skipped,
+    unless their content changed, but only after state has been committed.
+    """
+    store = StateStore.from_directory(str(tmp_path_factory.mktemp("state")))
+
+    def ingest():
+        pump = LuftdatenPumpe(state=store, incremental=True, domain="readings")
+        return pump, list(pump.get_readings_from_csv(str(archive)))
+
+    pump, readings = ingest()
+    assert len(readings) == 4
+    pump, readings = ingest()
+    assert len(readings) == 4
+    pump.commit()
+
+    pump, readings = ingest()
+    assert readings == []
+
+    # Touching a file does not make it eligible for processing again.
+    sds011 = archive / "2016-07-14" / "2016-07-14_sds011_sensor_92.csv"
+    os.utime(sds011, (0, 0))
+    pump, readings = ingest()
+    assert readings == []
+    pump.commit()
+
+    # Changing a file does.
+    sds011.write_text(SDS011_CSV.replace("7.71", "7.72"))
+    pump, readings = ingest()
+    assert summarize(readings) == [
+        ("2016-07-14T13:02:46.949036+00:00", {"P1": 7.72, "P2": 5.03}),
+        ("2016-07-14T13:05:12.108352+00:00", {"P1": 8.12}),
+    ]
+
+
+@pytest.mark.parametrize("workers", [None, 2])
+def test_archive_incremental_failed(archive, tmp_path_factory, workers):
+    """
+    In incremental mode, files which could not be decoded are not recorded,
+    so they will be processed again on subsequent invocations.
+    """
+    store = StateStore.from_directory(str(tmp_path_factory.mktemp("state")))
+    broken = archive / "2016-08-13" / "2016-08-13_dht22_sensor_49.csv.gz"
+    broken.write_bytes(b"\x1f\x8bfoo")
+
+    def ingest():
+        pump = LuftdatenPumpe(state=store, incremental=True, domain="readings", workers=workers)
+        readings = list(pump.get_readings_from_csv(str(archive)))
+        pump.commit()
+        return readings
+
+    assert len(ingest()) == 4
+    assert ingest() == []
+    assert len(store.load("ldi:manifest:readings")) == 2
+
+    with gzip.open(broken, "wt") as f:
+        f.write(DHT22_CSV.replace("48;", "49;"))
+    assert len(ingest()) == 2
+    assert len(store.load("ldi:manifest:readings")) == 3
+
+
+@pytest.mark.parametrize("workers", [None, 2])
+def test_archive_incremental_without_readings(archive, tmp_path_factory, monkeypatch, workers):
+    """
+    In incremental mode, files without any readings, e.g. of unsupported sensor
+    types or empty ones, are recorded, so they will not be hashed and decoded again.
+    """
+    store = StateStore.from_directory(str(tmp_path_factory.mktemp("state")))
+    (archive / "2016-08-13" / "2016-08-13_sps30_sensor_50.csv").write_text("sensor_id;sensor_type\n50;SPS30\n")
+    (archive / "2016-08-13" / "2016-08-13_dht22_sensor_51.csv").write_text("")
+
+    digests = []
+    monkeypatch.setattr(luftdaten_info, "archive_file_digest", lambda path: digests.append(path) or "foo")
+
+    def ingest():
+        pump = LuftdatenPumpe(state=store, incremental=True, domain="readings", workers=workers)
+        readings = list(pump.get_readings_from_csv(str(archive)))
+        pump.commit()
+        return readings
+
+    assert len(ingest()) == 4
+    assert len(digests) == 4
+    assert len(store.load("ldi:manifest:readings")) == 4
+
+    assert ingest() == []
+    assert len(digests) == 4
@@ -6,5 +6,6 @@ def test_import_all():
     from luftdatenpumpe.source import common, eea, irceline, luftdaten_info, openaq  # noqa:F401
     from luftdatenpumpe.source import rdbms as source_rdbms  # noqa:F401
     from luftdatenpumpe.target import stream  # noqa:F401
+    from luftdatenpumpe.target import threaded  # noqa:F401
     from luftdatenpumpe.target import influxdb, json, mqtt  # noqa:F401
     from luftdatenpumpe.target import rdbms as target_rdbms  # noqa:F401
@@ -0,0 +1,92 @@
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+from luftdatenpumpe.source.openaq import OpenAQPumpe
+from tests.conftest import FixtureRequestHandler
+
+RESULTS = [{"location": f"Location {number}"} for number in range(7)]
+
+
+def make_measurement(location, parameter, value, timestamp="2020-01-08T04:00:00.000Z"):
+    return {
+        "location": location,
+        "parameter": parameter,
+        "date": {"utc": timestamp},
+        "value": value,
+        "coordinates": {"latitude": 18.501, "longitude": 73.816},
+        "country": "IN",
+        "city": "Pune",
+    }
+
+
+MEASUREMENTS = [
+    make_measurement("Karve Road", "pm25", 77.4),
+    make_measurement("Karve Road", "pm10", 102.0),
+    make_measurement("Alandi", "pm25", 41.0),
+    make_measurement("Alandi", "pm10", -1),
+    make_measurement("Karve Road", "pm25", 75.1, timestamp="2020-01-08T03:00:00.000Z"),
+    make_measurement("Bhosari", "pm25", 60.3),
+]
+
+
+class OpenAQRequestHandler(FixtureRequestHandler):
+    """
+    Emulate the paging of the OpenAQ API. ``pages`` is a log of all requested pages.
+    """
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        page, limit = int(query["page"][0]), int(query["limit"][0])
+        self.pages.append(page)
+        results = MEASUREMENTS if url.path.endswith("/measurements") else RESULTS
+        data = {
+            "meta": {"found": len(results), "limit": limit, "page": page},
+            "results": results[(page - 1) * limit : page * limit],
+        }
+        self.respond(data)
+
+
+@pytest.fixture
+def openaq_api(http_server):
+    OpenAQRequestHandler.pages = []
+    return http_server(OpenAQRequestHandler, "")
+
+
+@pytest.mark.parametrize("concurrency", [None, 3])
+def test_pages(openaq_api, concurrency):
+    """
+    All result pages are acquired, yielding their results in order.
+    """
+    pump = OpenAQPumpe(concurrency=concurrency)
+    pump.uri = openaq_api
+    pump.page_size = 2
+    pages = list(pump.get_pages("latest", has_geo=True))
+    assert len(pages) == 4
+    assert [item for page in pages for item in page] == RESULTS
+
+
+def test_measurement_readings(openaq_api):
+    """
+    Measurements are grouped into readings per page, which are yielded as pages arrive.
+    """
+    pump = OpenAQPumpe()
+    pump.uri = openaq_api
+    pump.page_size = 2
+    pump.enrichment_deferred = True
+    readings = pump.get_current_measurement_readings()
+
+    reading = next(readings)
+    assert reading.station.station_id == "[IN] Karve Road"
+    assert [observation.data for observation in reading.observations] == [{"pm25": 77.4, "pm10": 102.0}]
+    assert max(OpenAQRequestHandler.pages) <= 2
+
+    readings = [reading, *readings]
+    assert [(reading.station.station_id, len(reading.observations)) for reading in readings] == [
+        ("[IN] Karve Road", 1),
+        ("[IN] Alandi", 1),
+        ("[IN] Karve Road", 1),
+        ("[IN] Bhosari", 1),
+    ]
+    assert sorted(OpenAQRequestHandler.pages) == [1, 2, 3]
@@ -0,0 +1,45 @@
+import pytest
+from munch import Munch
+
+from luftdatenpumpe.pipeline import Pipeline
+from luftdatenpumpe.source.common import AbstractLuftdatenPumpe
+
+
+def test_pipeline_stages():
+    """
+    Items pass all stages in order, items mapped to ``None`` are dropped.
+    """
+    pipeline = Pipeline(range(100), depth=3)
+    pipeline.add_stage("double", lambda item: item * 2)
+    pipeline.add_stage("drop", lambda item: item if item % 4 else None)
+    assert list(pipeline) == [item * 2 for item in range(100) if item % 2]
+
+
+def test_pipeline_source_error():
+    """
+    Exceptions raised while consuming the source are re-raised on the consumer side.
+    """
+
+    def source():
+        yield 1
+        raise KeyError("Something failed")
+
+    iterator = iter(Pipeline(source(), depth=1).add_stage("noop", lambda item: item))
+    assert next(iterator) == 1
+    with pytest.raises(KeyError):
+        next(iterator)
+
+
+def test_pipeline_deferred_enrichment():
+    """
+    When enrichment is deferred, it is carried out by the "enrich" pipeline stage.
+    """
+    pump = AbstractLuftdatenPumpe()
+    pump.enrichment_deferred = True
+
+    reading = Munch(station=Munch(station_id=42, position=Munch(latitude=48.778, longitude=9.236)))
+    pump.enrich_station(reading.station)
+    assert "geohash" not in reading.station.position
+
+    pipeline = Pipeline([reading]).add_stage("enrich", pump.enrich_item)
+    assert next(iter(pipeline)).station.position.geohash == "u0wt6pv2qqhz"
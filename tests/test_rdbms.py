@@ -0,0 +1,55 @@
+import pytest
+from munch import munchify
+
+from luftdatenpumpe.source.rdbms import locations_from_rdbms
+from luftdatenpumpe.target.rdbms import RDBMSStorage
+
+
+@pytest.fixture
+def dsuri(tmp_path, monkeypatch):
+    """
+    An SQLite database standing in for PostgreSQL, skipping the PostGIS-specific schema.
+    """
+    monkeypatch.setattr(RDBMSStorage, "ensure_postgis", lambda self: None)
+    monkeypatch.setattr(RDBMSStorage, "ensure_schema", lambda self: None)
+    return f"sqlite:///{tmp_path / 'luftdaten.sqlite'}"
+
+
+def make_station(station_id, location):
+    return munchify(
+        {
+            "station_id": station_id,
+            "name": "Ulmer Straße, Wangen, Stuttgart, Baden-Württemberg, DE",
+            "position": {"latitude": 48.778, "longitude": 9.236, "altitude": None, "country": "DE"},
+            "sensors": [{"sensor_id": station_id * 10, "sensor_type": "SDS011"}],
+            "location": location,
+        }
+    )
+
+
+def test_store_location_from_rdbms(dsuri):
+    """
+    Locations re-made from the database, lacking the bounding box,
+    can be stored again for other stations.
+    """
+    storage = RDBMSStorage(dsuri, network="luftdaten")
+    location = {
+        "place_id": 123,
+        "osm_type": "way",
+        "osm_id": 2678458514,
+        "display_name": "Ulmer Straße, Wangen, Stuttgart",
+        "boundingbox": ["48.77", "48.78", "9.23", "9.24"],
+        "address": {"road": "Ulmer Straße", "city": "Stuttgart", "country_code": "de", "foo": "bar"},
+        "address_more": {"foo": "bar"},
+    }
+    storage.store_station(make_station(1, location))
+
+    [(latitude, longitude, known)] = locations_from_rdbms(dsuri, "luftdaten")
+    assert (latitude, longitude) == (48.778, 9.236)
+    assert "boundingbox" not in known
+
+    storage.store_station(make_station(2, munchify(known)))
+    osmdata = {record["station_id"]: record for record in storage.osmtable.all()}
+    assert osmdata[2]["osm_display_name"] == "Ulmer Straße, Wangen, Stuttgart"
+    assert osmdata[2]["osm_road"] == "Ulmer Straße"
+    assert osmdata[2]["osm_id"] == 2678458514
@@ -0,0 +1,155 @@
+import pytest
+
+from luftdatenpumpe import commands
+from luftdatenpumpe.source.common import NotModified
+from luftdatenpumpe.source.luftdaten_info import LuftdatenPumpe
+from luftdatenpumpe.state import StateStore
+from tests.conftest import FixtureRequestHandler
+
+
+def make_item(sensor_id, timestamp):
+    return {"sensor": {"id": sensor_id}, "timestamp": timestamp}
+
+
+def test_state_store(tmp_path):
+    """
+    State is persisted per namespace.
+    """
+    path = tmp_path / "state" / "state.sqlite"
+    store = StateStore(str(path))
+    assert not path.exists()
+
+    store.update("foo", {"bar": 42, 43: {"baz": "qux"}})
+    store.update("other", {"bar": 0})
+    assert StateStore(str(path)).load("foo") == {"bar": 42, "43": {"baz": "qux"}}
+    assert store.get("foo", 43) == {"baz": "qux"}
+    assert store.get("foo", "unknown", default=-1) == -1
+
+    store.purge("foo")
+    assert store.load("foo") == {}
+    assert store.load("other") == {"bar": 0}
+
+
+def test_ldi_incremental(tmp_path):
+    """
+    LDI items not newer than the high-watermark of their sensor are skipped
+    on subsequent invocations, but only after state has been committed.
+    """
+    store = StateStore.from_directory(str(tmp_path))
+
+    pump = LuftdatenPumpe(state=store, incremental=True)
+    items = [make_item(1, "2019-04-25 04:30:00"), make_item(2, "2019-04-25 04:31:00")]
+    assert list(pump.skip_processed(items)) == items
+
+    # Without committing, nothing is skipped.
+    pump = LuftdatenPumpe(state=store, incremental=True)
+    assert list(pump.skip_processed(items)) == items
+    pump.commit()
+
+    pump = LuftdatenPumpe(state=store, incremental=True)
+    items = [
+        make_item(1, "2019-04-25 04:30:00"),
+        make_item(1, "2019-04-25 04:35:00"),
+        make_item(2, "2019-04-25 04:29:00"),
+        make_item(3, "2019-04-25 04:35:00"),
+    ]
+    assert list(pump.skip_processed(items)) == [items[1], items[3]]
+    pump.commit()
+
+    assert store.load("ldi:watermarks") == {
+        "1": "2019-04-25 04:35:00",
+        "2": "2019-04-25 04:31:00",
+        "3": "2019-04-25 04:35:00",
+    }
+
+
+def test_ldi_incremental_unordered(tmp_path):
+    """
+    Older LDI items of a sensor are not skipped when they appear after newer ones
+    within the same snapshot, and only the newest timestamp is recorded.
+    """
+    store = StateStore.from_directory(str(tmp_path))
+    store.update("ldi:watermarks", {"1": "2019-04-25 04:20:00"})
+
+    pump = LuftdatenPumpe(state=store, incremental=True)
+    items = [
+        make_item(1, "2019-04-25 04:35:00"),
+        make_item(1, "2019-04-25 04:30:00"),
+        make_item(1, "2019-04-25 04:15:00"),
+        make_item(2, "2019-04-25 04:31:00"),
+        make_item(2, "2019-04-25 04:29:00"),
+    ]
+    assert list(pump.skip_processed(items)) == [items[0], items[1], items[3], items[4]]
+    pump.commit()
+
+    assert store.load("ldi:watermarks") == {
+        "1": "2019-04-25 04:35:00",
+        "2": "2019-04-25 04:31:00",
+    }
+
+
+class FailingEngine:
+    def __init__(self, failures):
+        self.failures = failures
+
+    def process(self, data):
+        list(data)
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError("Data output target unavailable")
+
+
+def test_job_failure_discards_state(tmp_path, monkeypatch):
+    """
+    State recorded by a failed job run is not persisted by the next successful run.
+    """
+    store = StateStore.from_directory(str(tmp_path))
+    pump = LuftdatenPumpe(state=store, incremental=True)
+    engine = FailingEngine(failures=1)
+
+    runs = iter(
+        [
+            [make_item(1, "2019-04-25 04:30:00"), make_item(2, "2019-04-25 04:31:00")],
+            [make_item(1, "2019-04-25 04:20:00")],
+        ]
+    )
+    monkeypatch.setattr(commands, "get_data", lambda options, pump: pump.skip_processed(next(runs)))
+
+    with pytest.raises(ConnectionError):
+        commands.run_job(None, pump, engine)
+    assert pump.pending_state == {}
+
+    commands.run_job(None, pump, engine)
+    assert store.load("ldi:watermarks") == {"1": "2019-04-25 04:20:00"}
+
+
+class ValidatingRequestHandler(FixtureRequestHandler):
+    def do_GET(self):
+        if self.headers.get("If-None-Match") == '"v1"':
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.respond([], headers={"ETag": '"v1"'})
+
+
+def test_conditional_requests(tmp_path, http_server):
+    """
+    Conditional requests raise `NotModified` after the validators
+    of a previous response have been committed.
+    """
+    store = StateStore.from_directory(str(tmp_path))
+    url = http_server(ValidatingRequestHandler, "/data.json")
+
+    pump = LuftdatenPumpe(state=store, conditional_requests=True, domain="readings")
+    assert pump.http_get(url, conditional=True).json() == []
+    assert pump.http_get(url, conditional=True).json() == []
+    pump.commit()
+
+    pump = LuftdatenPumpe(state=store, conditional_requests=True, domain="readings")
+    with pytest.raises(NotModified):
+        pump.http_get(url, conditional=True)
+    assert pump.http_get(url).json() == []
+
+    # Validators are recorded per data domain.
+    pump = LuftdatenPumpe(state=store, conditional_requests=True, domain="stations")
+    assert pump.http_get(url, conditional=True).json() == []
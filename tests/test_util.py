@@ -0,0 +1,68 @@
+import json
+import os
+import zipfile
+
+import pytest
+
+from luftdatenpumpe.util import open_archive_file, open_zip_bundle, read_json_array, zip_members
+
+
+def chunked(payload, size):
+    return [payload[index : index + size] for index in range(0, len(payload), size)]
+
+
+@pytest.mark.parametrize("size", [1, 3, 64, 65536])
+def test_read_json_array(size):
+    """
+    Items of a top-level JSON array are decoded independently of chunk boundaries,
+    also when they split multi-byte characters or numbers.
+    """
+    data = [{"id": index, "label": "Ünterführung €" * index, "values": [1.5, None, True]} for index in range(25)]
+    data += [12345, "foo"]
+    payload = json.dumps(data, ensure_ascii=False).encode("utf-8")
+    assert list(read_json_array(chunked(payload, size))) == data
+
+
+def test_read_json_array_empty():
+    assert list(read_json_array([b" [ ", b"] "])) == []
+
+
+@pytest.mark.parametrize("payload", [b"", b"{}", b'[{"id": 1}, {"id"'])
+def test_read_json_array_invalid(payload):
+    with pytest.raises(ValueError):
+        list(read_json_array(chunked(payload, 4)))
+
+
+def test_zip_members_replaced(tmp_path):
+    """
+    The members of a ZIP file are read again when the file has been replaced.
+    """
+    path = str(tmp_path / "2019-04.zip")
+    with zipfile.ZipFile(path, "w") as bundle:
+        bundle.writestr("2019-04-01_sds011_sensor_92.csv", "")
+    assert list(zip_members(path)) == ["2019-04-01_sds011_sensor_92.csv"]
+
+    with zipfile.ZipFile(path, "w") as bundle:
+        bundle.writestr("2019-04-01_sds011_sensor_92.csv", "")
+        bundle.writestr("2019-04-02_sds011_sensor_92.csv", "")
+    os.utime(path, ns=(0, 10**9))
+    assert list(zip_members(path)) == ["2019-04-01_sds011_sensor_92.csv", "2019-04-02_sds011_sensor_92.csv"]
+
+
+def test_zip_bundle_opened_once(tmp_path):
+    """
+    Members of a ZIP file are read from a single open ZIP file, also when interleaved.
+    """
+    path = str(tmp_path / "2019-04.zip")
+    with zipfile.ZipFile(path, "w") as bundle:
+        for day in range(1, 4):
+            bundle.writestr(f"2019-04-0{day}_sds011_sensor_92.csv", f"2019-04-0{day}\n" * 1000)
+
+    open_zip_bundle.cache_clear()
+    members = [open_archive_file(f"{path}/{name}") for name in zip_members(path)]
+    lines = [[next(member) for member in members] for _ in range(2)]
+    assert lines == [["2019-04-01\n", "2019-04-02\n", "2019-04-03\n"]] * 2
+    assert [len(member.read()) for member in members] == [998 * 11] * 3
+    for member in members:
+        member.close()
+    assert open_zip_bundle.cache_info().misses == 1